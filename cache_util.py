@@ -0,0 +1,389 @@
+""" Caches for parsed upstream data, with interchangeable backends.
+
+make_cache picks the backend from the CACHE_BACKEND environment variable:
+memory (default; per process), sqlite (shared by every worker on one host, stored
+at CACHE_SQLITE_PATH) or redis (shared by every host, at REDIS_URL). """
+import os
+import time
+import pickle
+import random
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+# chance that a write to a SQLite cache also deletes the expired rows of its table
+CACHE_SQLITE_PURGE_CHANCE = float(os.environ.get("CACHE_SQLITE_PURGE_CHANCE", 0.01))
+
+
+def get_size(value):
+    """ Returns the approximate size in bytes of a cached value, measured as the
+    length of its pickled form."""
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class CacheBackend(object):
+    """ Interface shared by all cache backends. ttl is in seconds; None means the
+    value does not expire. Hits and misses are counted per process. shared is True
+    if every worker process sees the same entries."""
+    shared = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Returns the value stored for key, or default if it is not cached."""
+        found = self.get_many([key])
+
+        if key in found:
+            return found[key]
+
+        return default
+
+    def get_many(self, keys):
+        """ Returns a dictionary of {key: value} for the keys which are cached."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """ Stores value under key."""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """ Stores value under key only if nothing is stored there yet. Returns True
+        if the value was stored. This is atomic, so it can be used as a lock."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes key from the cache, if it is there."""
+        raise NotImplementedError
+
+    def clear(self):
+        """ Empties the cache."""
+        raise NotImplementedError
+
+    def after_fork(self):
+        """ Resets anything that must not be shared with the parent process."""
+        pass
+
+    def stats(self):
+        """ Returns a dictionary of the cache counters."""
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _count(self, keys, found):
+        """ Updates the hit and miss counters for a lookup."""
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+
+class LRUCache(CacheBackend):
+    """ Thread-safe in-process least-recently-used cache which evicts entries once
+    the total size of the stored values goes over max_bytes."""
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._items = OrderedDict()  # key: (value, size, expires at), oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._items:
+                    value, size, expires = self._items[key]
+
+                    if expires is not None and expires <= now:
+                        self._remove(key)
+                        continue
+
+                    self._items.move_to_end(key)
+                    found[key] = value
+
+            self._count(keys, found)
+
+        return found
+
+    def set(self, key, value, ttl=None):
+        """ Stores value under key, evicting the least recently used entries if
+        needed. Values larger than the whole budget are not stored."""
+        size = get_size(value)
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._store(key, value, size, expires)
+
+    def add(self, key, value, ttl=None):
+        size = get_size(value)
+        now = time.time()
+
+        with self._lock:
+            if key in self._items:
+                expires = self._items[key][2]
+
+                if expires is None or expires > now:
+                    return False
+
+            self._store(key, value, size, now + ttl if ttl is not None else None)
+            return key in self._items
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """ Empties the cache. Counters are kept."""
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def after_fork(self):
+        """ Empties the cache in a freshly forked process. The lock is replaced first,
+        since another thread of the parent may have been holding it."""
+        self._lock = threading.Lock()
+        self.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._items), "bytes": self._size, "max_bytes": self.max_bytes}
+
+    def _store(self, key, value, size, expires):
+        """ Stores an entry without locking; caller must hold the lock."""
+        self._remove(key)
+
+        if size > self.max_bytes:
+            return
+
+        self._items[key] = (value, size, expires)
+        self._size += size
+
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._items))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        """ Removes key without locking; caller must hold the lock."""
+        if key in self._items:
+            self._size -= self._items.pop(key)[1]
+
+
+class SQLiteCache(CacheBackend):
+    """ Cache stored in a SQLite file, so every worker process on the host shares it.
+    Each namespace gets its own table. Expired rows are deleted by purge_expired, which
+    one write in 1 / CACHE_SQLITE_PURGE_CHANCE runs."""
+    shared = True
+
+    def __init__(self, path, namespace):
+        super().__init__()
+        self.path = path
+        self.table = "cache_{}".format("".join(c if c.isalnum() else "_" for c in namespace))
+        self._local = threading.local()
+
+    def _connect(self):
+        """ Returns this thread's connection, opening it (and the table) if needed.
+        Connections are never shared between threads or processes."""
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value BLOB, expires REAL)".format(self.table))
+            conn.execute("CREATE INDEX IF NOT EXISTS {0}_expires ON {0} (expires)".format(self.table))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+
+        if keys:
+            query = "SELECT key, value FROM {} WHERE key IN ({}) AND (expires IS NULL OR expires > ?)".format(
+                self.table, ", ".join("?" * len(keys)))
+
+            for key, value in self._connect().execute(query, keys + [time.time()]):
+                found[key] = pickle.loads(value)
+
+        self._count(keys, found)
+        return found
+
+    def set(self, key, value, ttl=None):
+        self._connect().execute("INSERT OR REPLACE INTO {} VALUES (?, ?, ?)".format(self.table),
+                                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(ttl)))
+
+        if random.random() < CACHE_SQLITE_PURGE_CHANCE:
+            self.purge_expired()
+
+    def add(self, key, value, ttl=None):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            conn.execute("DELETE FROM {} WHERE key = ? AND expires <= ?".format(self.table), (key, time.time()))
+            cursor = conn.execute("INSERT OR IGNORE INTO {} VALUES (?, ?, ?)".format(self.table),
+                                  (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(ttl)))
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM {}".format(self.table))
+
+    def after_fork(self):
+        self._local = threading.local()
+
+    def purge_expired(self):
+        """ Deletes the expired rows of the table, returning how many there were."""
+        return self._connect().execute("DELETE FROM {} WHERE expires <= ?".format(self.table), (time.time(),)).rowcount
+
+    def _expires(self, ttl):
+        """ Returns the expiry timestamp for a ttl."""
+        return time.time() + ttl if ttl is not None else None
+
+
+class RedisCache(CacheBackend):
+    """ Cache stored in Redis, shared by every worker on every host. client is
+    anything speaking the redis-py interface used here (mget, set, delete and
+    scan_iter), such as a redis.StrictRedis or a LocalRedis stand-in."""
+
+    def __init__(self, client, namespace):
+        super().__init__()
+        self.client = client
+        self.shared = not isinstance(client, LocalRedis)
+        self.prefix = "bibliofind:{}:".format(namespace)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+
+        if keys:
+            for key, value in zip(keys, self.client.mget([self.prefix + key for key in keys])):
+                if value is not None:
+                    found[key] = pickle.loads(value)
+
+        self._count(keys, found)
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), px=self._expires(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                    px=self._expires(ttl), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+
+        if keys:
+            self.client.delete(*keys)
+
+    def _expires(self, ttl):
+        """ Returns the ttl in whole milliseconds, as Redis expects."""
+        return max(1, int(ttl * 1000)) if ttl is not None else None
+
+
+class LocalRedis(object):
+    """ In-process stand-in for a Redis client, supporting the commands RedisCache
+    uses. For tests, and for running without a Redis server."""
+
+    def __init__(self):
+        self._data = {}  # key: (value, expires at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.mget([key])[0]
+
+    def mget(self, keys):
+        with self._lock:
+            return [self._data[key][0] if self._live(key) else None for key in keys]
+
+    def set(self, key, value, px=None, nx=False):
+        with self._lock:
+            if nx and self._live(key):
+                return None
+
+            self._data[key] = (value, time.time() + px / 1000 if px is not None else None)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, match="*"):
+        prefix = match.rstrip("*")
+
+        with self._lock:
+            return [key for key in self._data if key.startswith(prefix)]
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+    def _live(self, key):
+        """ Returns True if key holds a value which has not expired."""
+        if key not in self._data:
+            return False
+
+        expires = self._data[key][1]
+        return expires is None or expires > time.time()
+
+
+_redis_client = None
+_caches = {}  # namespace: cache, for get_stats
+
+
+def get_redis_client():
+    """ Returns the Redis client for REDIS_URL, creating it on first use."""
+    global _redis_client
+
+    if _redis_client is None:
+        try:
+            import redis  # only needed when the redis backend is used
+
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package (pip install -r requirements.txt)")
+
+        _redis_client = redis.StrictRedis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+
+    return _redis_client
+
+
+def make_cache(namespace, max_bytes):
+    """ Returns a cache for namespace using the backend chosen by CACHE_BACKEND.
+    max_bytes is the budget of the in-process memory backend. The cache's counters
+    are reported by get_stats."""
+    backend = os.environ.get("CACHE_BACKEND", "memory")
+
+    if backend == "sqlite":
+        cache = SQLiteCache(os.environ.get("CACHE_SQLITE_PATH", "/tmp/bibliofind-cache.sqlite3"), namespace)
+
+    elif backend == "redis":
+        cache = RedisCache(get_redis_client(), namespace)
+
+    else:
+        cache = LRUCache(max_bytes)
+
+    _caches[namespace] = cache
+    return cache
+
+
+def get_stats():
+    """ Returns the counters of every cache made by make_cache, by namespace."""
+    return {namespace: cache.stats() for namespace, cache in _caches.items()}
@@ -0,0 +1,40 @@
+""" Release calendar over the series works stored in the database """
+import os
+
+from model import db, Book, Series, Series_Work, Author, Fav_Author, Fav_Series
+from server_util import format_pub_date
+
+RELEASES_PER_PAGE = int(os.environ.get("RELEASES_PER_PAGE", 20))
+
+
+def get_releases_between(start, end, user_id=None, page=1, per_page=RELEASES_PER_PAGE):
+    """ Returns a page (Flask-SQLAlchemy Pagination) of the stored books published
+    between start and end (inclusive), in date order. Items are (Book, Series,
+    position) tuples. If user_id is given, only books in that user's favorite series
+    or by their favorite authors are included."""
+    query = (db.session.query(Book, Series, Series_Work.position)
+             .join(Series_Work, Series_Work.book_id == Book.book_id)
+             .join(Series, Series.series_id == Series_Work.series_id)
+             .filter(Book.pub_date >= start, Book.pub_date <= end))
+
+    if user_id is not None:
+        fav_series = db.session.query(Fav_Series.series_id).filter(Fav_Series.user_id == user_id)
+        fav_authors = (db.session.query(Author.goodreads_id)
+                       .join(Fav_Author, Fav_Author.author_id == Author.author_id)
+                       .filter(Fav_Author.user_id == user_id, Author.goodreads_id.isnot(None)))
+        query = query.filter(db.or_(Series.series_id.in_(fav_series), Book.author_goodreads_id.in_(fav_authors)))
+
+    query = query.order_by(Book.pub_date, Book.book_id, Series.series_id)
+    return query.paginate(page, per_page, error_out=False)
+
+
+def release_to_dict(book, series, position):
+    """ Turns a (Book, Series, position) row into a dictionary for JSON responses."""
+    return {"title": book.title,
+            "author": book.author_name,
+            "published": format_pub_date(book.pub_date, book.pub_date_precision),
+            "precision": book.pub_date_precision,
+            "cover": book.cover_url,
+            "series": series.series_name,
+            "series_id": series.series_id,
+            "position": position}
@@ -1,22 +1,80 @@
 import os
-import requests
 import xml.etree.ElementTree as ET
 
-from server_util import convert_string_to_datetime
-from google_util import get_pub_date_with_title
+from datetime import datetime
+
+import upstream_util
+from cache_util import make_cache
+from ratelimit_util import RateLimiter
+from keypool_util import KeyPool, get_keys
+from server_util import strip_tags
+from release_util import SeriesReleaseIndex, parse_date
+from google_util import get_pub_date_with_title, get_cached_pub_date_with_title
 
 goodreads_key = os.environ["GOODREADS_API_KEY"]
 
+# Goodreads allows each key GOODREADS_QUOTA requests per second. Every Goodreads request waits
+# for a token from a per-process limiter, so PRECOMPUTE_GOODREADS_RATE of the quota is left to
+# precompute.py and the rest is split between the WEB_CONCURRENCY worker processes (exported by
+# gunicorn.conf.py), unless GOODREADS_RATE sets the per-process rate outright
+GOODREADS_QUOTA = float(os.environ.get("GOODREADS_QUOTA", 1))
+PRECOMPUTE_GOODREADS_RATE = float(os.environ.get("PRECOMPUTE_GOODREADS_RATE", 0.2))
+GOODREADS_RATE = float(os.environ.get("GOODREADS_RATE", (GOODREADS_QUOTA - PRECOMPUTE_GOODREADS_RATE)
+                                      / int(os.environ.get("WEB_CONCURRENCY", 1))))
+GOODREADS_BURST = int(os.environ.get("GOODREADS_BURST", 1))
+goodreads_limiter = RateLimiter(GOODREADS_RATE, GOODREADS_BURST)
+upstream_util.register_limiter("https://www.goodreads.com", goodreads_limiter)
+# requests are spread over the keys in GOODREADS_API_KEYS, if set (see keypool_util)
+goodreads_key_pool = KeyPool("Goodreads", get_keys("GOODREADS_API_KEYS", "GOODREADS_API_KEY"))
+upstream_util.register_key_pool("https://www.goodreads.com", goodreads_key_pool)
+
+# parsed series (keyed by goodreads series id) and series lists (keyed by goodreads author id)
+series_cache = make_cache("series", int(os.environ.get("SERIES_CACHE_BYTES", 8 * 1024 * 1024)))
+author_series_cache = make_cache("author_series", int(os.environ.get("AUTHOR_SERIES_CACHE_BYTES", 2 * 1024 * 1024)))
+# series data is kept fresh for between SERIES_TTL_MIN and SERIES_TTL_MAX seconds, depending
+# on how soon it could change (see get_series_ttl); SERIES_CACHE_TTL is used for series
+# waiting on an untitled book, or with no dates at all
+SERIES_CACHE_TTL = int(os.environ.get("SERIES_CACHE_TTL", 60 * 60))
+SERIES_TTL_MIN = int(os.environ.get("SERIES_TTL_MIN", 15 * 60))
+SERIES_TTL_MAX = int(os.environ.get("SERIES_TTL_MAX", 7 * 24 * 60 * 60))
+AUTHOR_SERIES_CACHE_TTL = int(os.environ.get("AUTHOR_SERIES_CACHE_TTL", 24 * 60 * 60))
+
+# typed author names (normalized) mapped to the (goodreads_id, goodreads_name) Goodreads
+# matched them to, and names Goodreads does not know, which are kept for less time
+author_cache = make_cache("author", int(os.environ.get("AUTHOR_CACHE_BYTES", 1024 * 1024)))
+unknown_author_cache = make_cache("unknown_author", int(os.environ.get("UNKNOWN_AUTHOR_CACHE_BYTES", 256 * 1024)))
+AUTHOR_CACHE_TTL = int(os.environ.get("AUTHOR_CACHE_TTL", 7 * 24 * 60 * 60))
+UNKNOWN_AUTHOR_CACHE_TTL = int(os.environ.get("UNKNOWN_AUTHOR_CACHE_TTL", 60 * 60))
+
+
+def normalize_author_name(author_name):
+    """ Returns the key author names are cached under, so the same name typed with
+    different case or spacing (e.g. "j.k.  rowling" and "J. K. Rowling") is looked
+    up once."""
+    return " ".join(author_name.lower().replace(".", ". ").split())
+
 
 def get_author_goodreads_info(author_name):
     """ Given author name, returns (goodreads_id, goodreads_name), if it exists.
-    Otherwise returns (None, None)."""
+    Otherwise returns (None, None). Matches are cached for the typed name and for the
+    name Goodreads corrected it to; names Goodreads does not know are cached separately
+    for UNKNOWN_AUTHOR_CACHE_TTL. Failed requests are not cached."""
+    key = normalize_author_name(author_name)
+
+    if unknown_author_cache.get(key):
+        return (None, None)
+
+    found = author_cache.get(key)
+
+    if found is not None:
+        return found
+
     goodreads_id = None
     goodreads_name = None
 
     payload = {"key": goodreads_key}
     url = "https://www.goodreads.com/api/author_url/{}".format(author_name)
-    response = requests.get(url, params=payload)
+    response = upstream_util.get(url, params=payload)
 
     if response.status_code == 200:
         tree = ET.fromstring(response.content)
@@ -25,6 +83,15 @@ def get_author_goodreads_info(author_name):
             goodreads_id = tree.find("author").attrib["id"]
             goodreads_name = tree.find("author").find("name").text
 
+    if goodreads_id is not None:
+        author_cache.set(key, (goodreads_id, goodreads_name), AUTHOR_CACHE_TTL)
+
+        if goodreads_name:
+            author_cache.set(normalize_author_name(goodreads_name), (goodreads_id, goodreads_name), AUTHOR_CACHE_TTL)
+
+    elif response.status_code in (200, 404):  # Goodreads answered, and does not know the name
+        unknown_author_cache.set(key, True, UNKNOWN_AUTHOR_CACHE_TTL)
+
     return (goodreads_id, goodreads_name)
 
 
@@ -63,115 +130,130 @@ def get_series_list_by_author(author_id):
     """ Queries the Goodreads API and gets a dictionary of series associated with this author id.
     If error occured, returns None. If no series are found, returns empty dictionary. """
     payload = {"key": goodreads_key, "id": author_id}
-    response = requests.get("https://www.goodreads.com/series/list", params=payload)
+    return upstream_util.get_parsed("https://www.goodreads.com/series/list", payload, parse_series_list,
+                                    author_series_cache, str(author_id), AUTHOR_SERIES_CACHE_TTL)
 
-    if response.status_code == 200:
-        tree = ET.fromstring(response.content)
 
-        if tree.find("series_works"):
-            all_series = list(tree.find("series_works"))
-            return sort_series(all_series)
+def parse_series_list(response):
+    """ Given a Goodreads series/list response, returns the dictionary of series
+    described in get_series_list_by_author."""
+    tree = ET.fromstring(response.content)
 
-        else:  # no series found
-            return {}
+    if tree.find("series_works"):
+        all_series = list(tree.find("series_works"))
+        return sort_series(all_series)
 
-    else:  # could not make a response, or something happened
-        return None
+    else:  # no series found
+        return {}
 
 
-def get_last_book_of_series(series_name, series_id, date, timeframe):
-    """ Given a series name, date of search, and timeframe, returns a dictionary containing the info of the
-    last book published in that series in the timeframe provided. If API error, returns
-    a dictionary with key 'status' and value 'error'."""
+def get_series_info(series_id):
+    """ Gets the description, length and works of a series from the Goodreads API.
+    Only the parsed values are kept in series_cache, and are revalidated with Goodreads
+    once stale. If error occured, returns None. Result format:
+    {"description": str, "length": str, "works": [work info dictionaries]}"""
     payload = {"key": goodreads_key, "id": series_id}
-    response = requests.get("https://www.goodreads.com/series/show/", params=payload)
+    return upstream_util.get_parsed("https://www.goodreads.com/series/show/", payload,
+                                    lambda response: parse_series(ET.fromstring(response.content).find("series")),
+                                    series_cache, str(series_id), get_series_ttl)
 
-    if response.status_code == 200:
-        tree = ET.fromstring(response.content)
-        series_length = tree.find("series").find("primary_work_count").text
-        series_works = list(tree.find("series").find("series_works"))
-        by_user_position = {}
 
-        for work in series_works:
-            user_position = work.find("user_position").text
-            by_user_position[user_position] = work
+def get_series_ttl(series_info, now=None):
+    """ Returns how many seconds the info of a series can be used before checking
+    Goodreads again, between SERIES_TTL_MIN and SERIES_TTL_MAX. A series with a book
+    coming out is checked more often the closer the release is; one waiting on an
+    untitled book is checked every SERIES_CACHE_TTL; otherwise, the longer since its
+    last book came out, the less often it is checked."""
+    now = now or datetime.now()
+    next_release = None
+    last_release = None
+    has_placeholder = False
 
-        title = 'untitled'
-        published = None
+    for work in series_info["works"]:
+        pdate = parse_date(work["published"])
 
-        while ('untitled' in title.lower() and published is None) and series_length >= "1":
-            work = by_user_position.get(series_length)
+        if pdate is None:
+            has_placeholder = has_placeholder or 'untitled' in work["title"].lower()
 
-            if work is None:
-                last_position = max(by_user_position.keys())
-                work = by_user_position[last_position]
+        elif pdate > now:
+            next_release = min(next_release or pdate, pdate)
 
-            work_info = get_info_for_work(work)
-            title = work_info["title"]
-            published = work_info["published"]
-            cover = work_info["cover"]
+        else:
+            last_release = max(last_release or pdate, pdate)
 
-            series_length = str(int(series_length) - 1)
+    if next_release is not None:
+        ttl = (next_release - now).total_seconds() / 4
 
-        if published is None:
-            published = get_pub_date_with_title(title)
+    elif has_placeholder or last_release is None:
+        ttl = SERIES_CACHE_TTL
 
-        if published == "error":
-            return {"status": "error"}
+    else:
+        ttl = (now - last_release).total_seconds() / 10
 
-        result = ("Title: <i>{}</i>".format(title), "Publication date: {}".format(published), cover)
+    return int(min(max(ttl, SERIES_TTL_MIN), SERIES_TTL_MAX))
 
-        pdate = convert_string_to_datetime(published)
 
-        if (not timeframe) and not (pdate <= date):
-            while series_length >= "1":
-                work = by_user_position[series_length]
-                work = by_user_position[series_length]
-                work_info = get_info_for_work(work)
-                title2 = work_info["title"]
-                published2 = work_info["published"]
-                cover = work_info["cover"]
+def parse_series(series):
+    """ Given the series node of a Goodreads series/show response, returns a dictionary
+    with its description, length and the info of each of its works. Along with what
+    get_info_for_work returns, each work has its position, work_id and author_id."""
+    description = series.find("description")
+    works = []
 
-                if published2 is None:
-                    published2 = get_pub_date_with_title(title)
+    for work in series.find("series_works"):
+        work_info = get_info_for_work(work)
+        work_info["position"] = (work.find("user_position").text or "").strip()
+        work_info["work_id"] = find_text(work, "work/id")
+        work_info["author_id"] = find_text(work, "work/best_book/author/id")
+        works.append(work_info)
 
-                pdate2 = convert_string_to_datetime(published2)
+    return {"description": strip_tags(description.text.strip()) if description is not None and description.text else "",
+            "length": series.find("primary_work_count").text.strip(),
+            "works": works}
 
-                if pdate2 <= date:
-                    result = ("Title: <i>{}</i>".format(title2), "Publication date: {}".format(published2), cover)
-                    break
 
-                series_length = str(int(series_length) - 1)
+def find_text(node, path):
+    """ Returns the stripped text of the node at path, or None if there is none."""
+    found = node.find(path)
 
-        if timeframe and not (date <= pdate <= date + timeframe):
-            if pdate < date:
-                result = (None, None, "http://sendmeglobal.net/images/404.png")
+    if found is None or found.text is None:
+        return None
 
-            else:
-                while series_length >= "1":
-                    work = by_user_position[series_length]
-                    work_info = get_info_for_work(work)
-                    title2 = work_info["title"]
-                    published2 = work_info["published"]
-                    cover = work_info["cover"]
+    return found.text.strip()
 
-                    if published2 is None:
-                        published2 = get_pub_date_with_title(title)
 
-                    pdate2 = convert_string_to_datetime(published2)
+def get_last_book_of_series(series_name, series_id, date, timeframe, series_info=None):
+    """ Given a series name, date of search, and timeframe, returns a dictionary containing the info of the
+    last book published in that series in the timeframe provided. If API error, returns
+    a dictionary with key 'status' and value 'error'. series_info can be passed in if the
+    series is already known (e.g. stored in the database); otherwise it is fetched. If a
+    publication date the search needed could not be looked up, the result has 'degraded'
+    set to True, as it may be wrong.
+
+    With no timeframe, the result is the most recent book published on or before date;
+    otherwise it is the first book published between date and date + timeframe."""
+    if series_info is None:
+        series_info = get_series_info(series_id)
+
+    if series_info is not None:
+        index = SeriesReleaseIndex(series_info["works"], series_info["length"], get_pub_date_with_title,
+                                   cached_date=get_cached_pub_date_with_title)
 
-                    if pdate2 < date:
-                        result = (None, None, "http://sendmeglobal.net/images/404.png")
-                        break
+        if timeframe:
+            found = index.first_between(date, date + timeframe)
 
-                    elif pdate <= pdate2 <= date + timeframe:
-                        result = ("Title: <i>{}</i>".format(title2), "Publication date: {}".format(published2), cover)
-                        break
+        else:
+            found = index.latest_on_or_before(date)
+
+        if found is None:
+            result = (None, None, "http://sendmeglobal.net/images/404.png")
 
-                    series_length = str(int(series_length) - 1)
+        else:
+            work, published = found
+            result = ("Title: <i>{}</i>".format(work["title"]), "Publication date: {}".format(published), work["cover"])
 
-            if series_length == "0":
-                result = (None, None, "http://sendmeglobal.net/images/404.png")
+        if index.degraded:
+            return {'status': 'ok', 'results': result, 'degraded': True}
 
         return {'status': 'ok', 'results': result}
 
@@ -1,40 +1,96 @@
-import requests
 import os
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+
+import upstream_util
+from cache_util import make_cache
+from keypool_util import KeyPool, get_keys
 
 google_books_key = os.environ["GOOGLE_BOOKS_API_KEY"]
+# requests are spread over the keys in GOOGLE_BOOKS_API_KEYS, if set (see keypool_util)
+google_books_key_pool = KeyPool("Google Books", get_keys("GOOGLE_BOOKS_API_KEYS", "GOOGLE_BOOKS_API_KEY"))
+upstream_util.register_key_pool("https://www.googleapis.com", google_books_key_pool)
+# publication dates found, keyed by title and by Google Book ID; errors are not cached
+title_date_cache = make_cache("title_date", int(os.environ.get("TITLE_DATE_CACHE_BYTES", 512 * 1024)))
+volume_date_cache = make_cache("volume_date", int(os.environ.get("VOLUME_DATE_CACHE_BYTES", 512 * 1024)))
+DATE_CACHE_TTL = int(os.environ.get("DATE_CACHE_TTL", 7 * 24 * 60 * 60))
+# how many volume lookups may run at once; 1 makes lookups serial
+GOOGLE_BOOKS_MAX_WORKERS = int(os.environ.get("GOOGLE_BOOKS_MAX_WORKERS", 5))
+# set to 1 to send a duplicate of slow Google Books requests (see upstream_util.get_hedged)
+GOOGLE_BOOKS_HEDGING = os.environ.get("GOOGLE_BOOKS_HEDGING") == "1"
 
 
 def get_pub_date_with_title(title):
     """ Gets the publication date for a book based off its title. Returns string
-    with value error if there is an API error. """
-    # need to change how I handle this; what if the book has a title but no release date?
+    with value error if there is an API error. The date is read from the search
+    result itself; the volume is only looked up if the search result has no date."""
+    published = title_date_cache.get(title)
+
+    if published is not None:
+        return published
+
     payload = {"q": title,
                "langRestrict": "en",
                "printType": "books",
+               "maxResults": 1,
+               "fields": "items(id,volumeInfo/publishedDate)",
                "key": google_books_key
                }
 
-    r2 = requests.get("https://www.googleapis.com/books/v1/volumes", params=payload)
+    r2 = upstream_util.get("https://www.googleapis.com/books/v1/volumes", params=payload, hedge=GOOGLE_BOOKS_HEDGING)
 
     if r2.status_code == 200:
         r2_json = r2.json()
-        google_id = r2_json["items"][0]["id"]
-        return get_pub_date_with_book_id(google_id)
+
+        if not r2_json.get("items"):  # nothing matched the title
+            return "error"
+
+        book = r2_json["items"][0]
+        published = book.get("volumeInfo", {}).get("publishedDate")
+
+        if not published:
+            published = get_pub_date_with_book_id(book["id"])
+
+        if published != "error":
+            title_date_cache.set(title, published, DATE_CACHE_TTL)
+
+        return published
 
     else:
         return "error"
 
 
+def get_cached_pub_date_with_title(title):
+    """ Returns the publication date get_pub_date_with_title found for title, if it
+    is still cached, or None, without making a request."""
+    return title_date_cache.get(title)
+
+
 def get_pub_date_with_book_id(google_id):
     """ Gets a publicatioon date for a book based off its Google Book ID. Returns
     string with value error if there is an API error."""
-    payload = {"key": google_books_key}
+    payload = {"fields": "volumeInfo/publishedDate", "key": google_books_key}
     url = "https://www.googleapis.com/books/v1/volumes/{}".format(google_id)
-    r2 = requests.get(url, params=payload)
-
-    if r2.status_code == 200:
-        results_2 = r2.json()
-        return results_2["volumeInfo"]["publishedDate"]
+    published = upstream_util.get_parsed(url, payload, lambda r2: r2.json().get("volumeInfo", {}).get("publishedDate"),
+                                         volume_date_cache, google_id, DATE_CACHE_TTL, hedge=GOOGLE_BOOKS_HEDGING)
 
-    else:
+    if published is None:
         return "error"
+
+    return published
+
+
+def get_pub_dates_with_book_ids(google_ids, max_workers=GOOGLE_BOOKS_MAX_WORKERS):
+    """ Gets the publication dates for several Google Book IDs, looking them up
+    concurrently. Returns a list of dates in the same order as the ids given; as with
+    get_pub_date_with_book_id, a date is the string error if its lookup failed."""
+    google_ids = list(google_ids)
+
+    if max_workers <= 1 or len(google_ids) <= 1:
+        return [get_pub_date_with_book_id(google_id) for google_id in google_ids]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(google_ids))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, get_pub_date_with_book_id, google_id)
+                   for google_id in google_ids]
+        return [future.result() for future in futures]
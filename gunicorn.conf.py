@@ -0,0 +1,21 @@
+""" Gunicorn settings for serving the app with several worker processes """
+import os
+import multiprocessing
+
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# the workers split each Goodreads key's quota between them (see goodreads_util.GOODREADS_RATE)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+# load the app once in the master so workers start quickly; per-worker state is set up in post_worker_init
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def post_worker_init(worker):
+    """ Gives each worker its own database connections, HTTP pools and caches. Runs
+    once the worker has the app loaded, which without preload_app happens after the
+    fork, so the database is always set up by then."""
+    from server import init_worker
+    init_worker()
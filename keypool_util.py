@@ -0,0 +1,142 @@
+""" Pools of API keys for upstreams whose quota is per key (Goodreads, Google Books) """
+import os
+import time
+import logging
+import itertools
+import threading
+
+from collections import OrderedDict
+
+# how long a key is left alone after the upstream refuses it (429 or 403)
+API_KEY_COOLDOWN = int(os.environ.get("API_KEY_COOLDOWN", 15 * 60))
+# how keys are picked: round_robin, or least_used (fewest requests this hour)
+API_KEY_SELECTION = os.environ.get("API_KEY_SELECTION", "round_robin")
+# hours of usage kept for the report
+API_KEY_USAGE_HOURS = int(os.environ.get("API_KEY_USAGE_HOURS", 24))
+# reasons Google gives for a 403 when a key is over its quota; other 403s (e.g. a bad key) do
+# not cool the key down
+QUOTA_REASONS = {"dailyLimitExceeded", "rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
+
+logger = logging.getLogger(__name__)
+
+
+def get_keys(list_variable, single_variable):
+    """ Returns the keys in the comma-separated environment variable list_variable,
+    or the one key in single_variable if it is not set."""
+    keys = [key.strip() for key in os.environ.get(list_variable, "").split(",") if key.strip()]
+    return keys or [os.environ[single_variable]]
+
+
+def get_error_reason(response):
+    """ Returns the reason of a Google-style JSON error response, or None if the
+    response has none (e.g. it is not JSON)."""
+    try:
+        return response.json()["error"]["errors"][0]["reason"]
+
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def mask_key(api_key):
+    """ Returns a key shortened to its last four characters, for reports."""
+    return "..." + api_key[-4:]
+
+
+class KeyPool(object):
+    """ Hands out the keys of one upstream, skipping keys that are cooling down
+    after being refused, and counts the requests made with each key per hour."""
+
+    def __init__(self, name, keys, selection=None, cooldown=None):
+        self.name = name
+        self.keys = list(keys)
+        self.selection = selection or API_KEY_SELECTION
+        self.cooldown = cooldown if cooldown is not None else API_KEY_COOLDOWN
+        self.cooling_until = {}  # key: time it can be used again
+        self.usage = OrderedDict()  # hour: {key: {"requests", "refused"}}, oldest first
+        self._next = itertools.cycle(range(len(self.keys)))
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """ Returns the key to use for the next request, or None if every key is
+        cooling down."""
+        now = time.time()
+
+        with self._lock:
+            available = [key for key in self.keys if self.cooling_until.get(key, 0) <= now]
+
+            if not available:
+                return None
+
+            if self.selection == "least_used":
+                hour = self.usage.get(self._get_hour(now), {})
+                return min(available, key=lambda key: hour.get(key, {}).get("requests", 0))
+
+            for i in range(len(self.keys)):
+                key = self.keys[next(self._next)]
+
+                if key in available:
+                    return key
+
+    def report(self, api_key, status_code, reason=None):
+        """ Records a request made with api_key, and cools the key down if the
+        upstream refused it: a 429, or a 403 whose error reason (see
+        get_error_reason) is a quota one or is not known."""
+        now = time.time()
+
+        with self._lock:
+            counts, last_hour = self._get_counts(now, api_key)
+            counts["requests"] += 1
+
+            if status_code == 429 or (status_code == 403 and (reason is None or reason in QUOTA_REASONS)):
+                counts["refused"] += 1
+                self.cooling_until[api_key] = now + self.cooldown
+
+        if last_hour is not None:
+            hour, keys = last_hour
+            logger.info("%s API key usage for %s: %s", self.name, hour, ", ".join(
+                "{} {requests} requests ({refused} refused)".format(mask_key(key), **counts)
+                for key, counts in keys.items()))
+
+    def usage_report(self):
+        """ Returns the requests made and refused per key for each hour kept, oldest
+        first, as {hour: {masked key: counts}}."""
+        with self._lock:
+            return OrderedDict((hour, {mask_key(key): dict(counts) for key, counts in keys.items()})
+                               for hour, keys in self.usage.items())
+
+    def stats(self):
+        """ Returns which keys are cooling down, and the usage report."""
+        now = time.time()
+
+        with self._lock:
+            cooling = {mask_key(key): round(until - now) for key, until in self.cooling_until.items() if until > now}
+
+        return {"keys": len(self.keys), "cooling_down": cooling, "usage": self.usage_report()}
+
+    def after_fork(self):
+        """ Starts a freshly forked process with its own lock and usage counts."""
+        self._lock = threading.Lock()
+        self.usage = OrderedDict()
+
+    def _get_hour(self, now):
+        """ Returns the hour a timestamp falls in, as used to key the usage."""
+        return time.strftime("%Y-%m-%d %H:00", time.localtime(now))
+
+    def _get_counts(self, now, api_key):
+        """ Returns the counters of api_key for the current hour, starting a new hour
+        if needed, and (hour, usage) of the hour that just ended, or None if none did,
+        so its usage can be logged. Caller must hold the lock."""
+        hour = self._get_hour(now)
+        last_hour = None
+
+        if hour not in self.usage:
+            if self.usage:
+                ended, keys = next(reversed(self.usage.items()))
+                last_hour = (ended, {key: dict(counts) for key, counts in keys.items()})
+
+            self.usage[hour] = {}
+
+            while len(self.usage) > API_KEY_USAGE_HOURS:
+                self.usage.popitem(last=False)
+
+        return self.usage[hour].setdefault(api_key, {"requests": 0, "refused": 0}), last_hour
@@ -69,8 +69,12 @@ class Series(db.Model):
     series_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     series_name = db.Column(db.String(200), nullable=False)
     goodreads_id = db.Column(db.String(50), nullable=False)
+    description = db.Column(db.Text, nullable=True)
+    work_count = db.Column(db.Integer, nullable=True)
+    works_updated_at = db.Column(db.DateTime, nullable=True)
 
     favorited_by = db.relationship("Fav_Series")
+    works = db.relationship("Series_Work", order_by="Series_Work.series_work_id")
 
     def __repr__(self):
         return "<Series {}, series name {}>".format(self.series_id, self.series_name)
@@ -91,9 +95,70 @@ class Fav_Series(db.Model):
         return "<Fav Series {}, series {} favorited by User {}>".format(self.fav_series_id, self.series_id, self.user_id)
 
 
+class Book(db.Model):
+    """ Books which are part of series included in project """
+    __tablename__ = "books"
+
+    book_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    goodreads_work_id = db.Column(db.String(20), nullable=True, index=True, unique=True)
+    title = db.Column(db.String(300), nullable=False)
+    author_name = db.Column(db.String(100), nullable=True)
+    author_goodreads_id = db.Column(db.String(15), nullable=True, index=True)
+    cover_url = db.Column(db.String(300), nullable=True)
+    pub_date = db.Column(db.Date, nullable=True, index=True)
+    pub_date_precision = db.Column(db.String(5), nullable=True)  # year, month or day
+
+    in_series = db.relationship("Series_Work")
+
+    def __repr__(self):
+        return "<Book {}, title: {}>".format(self.book_id, self.title)
+
+
+class Series_Work(db.Model):
+    """ Association table to keep track of which books are in which series"""
+    __tablename__ = "series_works"
+    __table_args__ = (db.UniqueConstraint("series_id", "book_id"),)
+
+    series_work_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    series_id = db.Column(db.Integer, db.ForeignKey("series.series_id"), nullable=False, index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey("books.book_id"), nullable=False)
+    position = db.Column(db.String(20), nullable=True)
+
+    series = db.relationship("Series")
+    book = db.relationship("Book", lazy="joined")  # loaded with the series works, in one query
+
+    def __repr__(self):
+        return "<Series Work {}, book {} at position {} of series {}>".format(self.series_work_id, self.book_id,
+                                                                             self.position, self.series_id)
+
+
+class Series_Result(db.Model):
+    """ Search result precomputed for a series, day and timeframe (see precompute.py)"""
+    __tablename__ = "series_results"
+    __table_args__ = (db.UniqueConstraint("series_id", "timeframe"),)
+
+    series_result_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    series_id = db.Column(db.Integer, db.ForeignKey("series.series_id"), nullable=False)
+    timeframe = db.Column(db.Integer, nullable=False)  # in days, as in server.timeframes
+    search_date = db.Column(db.Date, nullable=False)
+    title = db.Column(db.String(400), nullable=True)
+    published = db.Column(db.String(50), nullable=True)
+    cover = db.Column(db.String(300), nullable=True)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    series = db.relationship("Series")
+
+    def __repr__(self):
+        return "<Series Result {}, series {} for {} days from {}>".format(self.series_result_id, self.series_id,
+                                                                         self.timeframe, self.search_date)
+
+
 def example_data():
     """ Data used for tests.py"""
     # in case this is run twice, empty out existing data
+    Series_Result.query.delete()
+    Series_Work.query.delete()
+    Book.query.delete()
     Fav_Series.query.delete()
     Fav_Author.query.delete()
     User.query.delete()
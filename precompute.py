@@ -0,0 +1,59 @@
+""" Precomputes the search result of every series for each timeframe, so series
+searches can be answered with a single database read.
+
+Run with `python3 precompute.py` to recompute every PRECOMPUTE_INTERVAL seconds, or
+`python3 precompute.py --once` (e.g. from cron) to run a single pass. It runs in its
+own process, so it gets its own share of each Goodreads key's quota:
+PRECOMPUTE_GOODREADS_RATE requests per second."""
+import os
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+import upstream_util
+import ratelimit_util
+from goodreads_util import goodreads_limiter, PRECOMPUTE_GOODREADS_RATE
+from model import connect_to_db, Series
+from series_util import save_precomputed_result
+from server import app, timeframes, compute_series_search_results
+
+PRECOMPUTE_INTERVAL = int(os.environ.get("PRECOMPUTE_INTERVAL", 6 * 60 * 60))
+
+
+def precompute_all(day=None):
+    """ Computes and stores the results of every series and timeframe for day (today
+    by default), at background priority so interactive requests go first. Results
+    which could not be computed, were built from stale data, or are degraded (worked
+    out without a publication date they needed) are not stored.
+    Returns the number of results stored."""
+    day = day or datetime.now().date()
+    py_date = datetime(day.year, day.month, day.day)
+    stored = 0
+
+    with ratelimit_util.priority(ratelimit_util.BACKGROUND):
+        for series in Series.query.order_by(Series.series_id).all():
+            for timeframe in timeframes:
+                upstream_util.track_stale()
+                results = compute_series_search_results(series, py_date, timedelta(days=timeframe))
+
+                if results["status"] == "ok" and not results.get("degraded") and not upstream_util.served_stale():
+                    save_precomputed_result(series, day, timeframe, results["results"])
+                    stored += 1
+
+    return stored
+
+
+if __name__ == "__main__":
+    connect_to_db(app, os.environ.get("DATABASE_URL", "postgresql:///project"))
+    goodreads_limiter.rate = PRECOMPUTE_GOODREADS_RATE
+
+    while True:
+        started = time.time()
+        stored = precompute_all()
+        print("Precomputed {} results in {:.1f}s".format(stored, time.time() - started))
+
+        if "--once" in sys.argv:
+            break
+
+        time.sleep(PRECOMPUTE_INTERVAL)
@@ -0,0 +1,174 @@
+""" Rate limiting for upstream APIs with per-key quotas (Goodreads) """
+import os
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+
+from contextlib import contextmanager
+
+# priority classes: waiting interactive calls always get the next token before background ones
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# longest a call waits for a token when its request has no deadline
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 30))
+
+_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level):
+    """ Runs the upstream calls made inside the with block (and in worker threads
+    started from it) at the priority given."""
+    token = _priority.set(level)
+
+    try:
+        yield
+
+    finally:
+        _priority.reset(token)
+
+
+def get_priority():
+    """ Returns the priority of the current context."""
+    return _priority.get()
+
+
+class TokenBucket(object):
+    """ Token bucket handing out up to rate tokens per second, with bursts of up to
+    capacity tokens. Not thread-safe; PriorityScheduler locks around it."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def refill(self, now):
+        """ Adds the tokens earned since the last refill."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_token(self):
+        """ Returns the seconds until a whole token is available."""
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class PriorityScheduler(object):
+    """ Hands out the tokens of one bucket to waiting callers, highest priority first
+    and first come, first served within a priority."""
+
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, ticket number)
+        self._tickets = itertools.count()
+        self.granted = {level: 0 for level in PRIORITY_NAMES}
+        self.timeouts = {level: 0 for level in PRIORITY_NAMES}
+        self.waited = {level: 0.0 for level in PRIORITY_NAMES}
+        self.max_wait = {level: 0.0 for level in PRIORITY_NAMES}
+
+    def acquire(self, level=INTERACTIVE, timeout=None):
+        """ Waits for a token. Returns True once one is taken, or False if none could
+        be had within timeout seconds."""
+        started = time.time()
+        ticket = (level, next(self._tickets))
+
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+
+            while True:
+                now = time.time()
+                self.bucket.refill(now)
+
+                if self._queue[0] == ticket and self.bucket.tokens >= 1:
+                    heapq.heappop(self._queue)
+                    self.bucket.tokens -= 1
+                    self._record(level, now - started)
+                    self._cond.notify_all()  # the next in line may be able to go
+                    return True
+
+                remaining = None if timeout is None else started + timeout - now
+
+                if remaining is not None and remaining <= 0:
+                    self._queue.remove(ticket)
+                    heapq.heapify(self._queue)
+                    self.timeouts[level] += 1
+                    self._cond.notify_all()
+                    return False
+
+                # the head of the queue sleeps until a token is due; the rest until woken
+                wait = self.bucket.time_until_token() if self._queue[0] == ticket else remaining
+
+                if wait is not None and remaining is not None:
+                    wait = min(wait, remaining)
+
+                self._cond.wait(wait)
+
+    def _record(self, level, seconds):
+        """ Updates the wait counters; caller must hold the lock."""
+        self.granted[level] += 1
+        self.waited[level] += seconds
+        self.max_wait[level] = max(self.max_wait[level], seconds)
+
+    def stats(self):
+        """ Returns the queue depth and wait times, per priority."""
+        with self._cond:
+            stats = {}
+
+            for level, name in PRIORITY_NAMES.items():
+                granted = self.granted[level]
+                stats[name] = {"queued": sum(1 for queued in self._queue if queued[0] == level),
+                               "granted": granted,
+                               "timeouts": self.timeouts[level],
+                               "avg_wait": round(self.waited[level] / granted, 3) if granted else 0,
+                               "max_wait": round(self.max_wait[level], 3)}
+
+            return stats
+
+
+class RateLimiter(object):
+    """ Rate limit for an upstream whose quota is per API key: each key (the key
+    param of a request) gets its own PriorityScheduler. rate and capacity are per
+    process, so with several workers they should be the key's quota divided by the
+    number of workers."""
+
+    def __init__(self, rate, capacity=1, key_param="key"):
+        self.rate = rate
+        self.capacity = capacity
+        self.key_param = key_param
+        self._schedulers = {}
+        self._lock = threading.Lock()
+
+    def get_scheduler(self, api_key):
+        """ Returns the scheduler for an API key, creating it if needed."""
+        with self._lock:
+            scheduler = self._schedulers.get(api_key)
+
+            if scheduler is None:
+                scheduler = PriorityScheduler(self.rate, self.capacity)
+                self._schedulers[api_key] = scheduler
+
+            return scheduler
+
+    def acquire(self, params, timeout=None):
+        """ Waits for a token for the API key in params, at the current priority.
+        Returns False if none could be had within timeout seconds."""
+        api_key = (params or {}).get(self.key_param) or ""
+        return self.get_scheduler(api_key).acquire(get_priority(), timeout)
+
+    def after_fork(self):
+        """ Drops the schedulers in a freshly forked process."""
+        self._lock = threading.Lock()
+        self._schedulers = {}
+
+    def stats(self):
+        """ Returns the scheduler stats of each key, with keys shortened to their
+        last four characters."""
+        with self._lock:
+            schedulers = list(self._schedulers.items())
+
+        return {"..." + api_key[-4:]: scheduler.stats() for api_key, scheduler in schedulers}
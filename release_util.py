@@ -0,0 +1,172 @@
+""" Release index used to answer timeframe queries over the works of a series """
+import os
+
+from server_util import convert_string_to_datetime
+
+# most Google Books lookups a single index may make to fill in missing dates
+RELEASE_INDEX_MAX_LOOKUPS = int(os.environ.get("RELEASE_INDEX_MAX_LOOKUPS", 6))
+
+
+def parse_position(position):
+    """ Returns a series position as a float, or None if it is not a single number
+    (e.g. an omnibus at position 1-3)."""
+    try:
+        return float(position)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_date(date_string):
+    """ Returns a datetime for a publication date string, or None if it is not a date."""
+    try:
+        return convert_string_to_datetime(date_string)
+    except (AttributeError, ValueError):
+        return None
+
+
+class SeriesReleaseIndex(object):
+    """ Index over the primary works of a series (whole-numbered positions from 1 to
+    the series length), ordered by publication date.
+
+    Dates Goodreads does not have are resolved with resolve_date(title) only when a
+    query needs them, and queries are binary searches, so a query resolves at most a
+    logarithmic number of dates. Only lookups count against max_lookups: a date
+    cached_date(title) already knows (without a request) is free. Until every date is known, works are ordered by
+    position, i.e. books are assumed to come out in series order. Untitled works are
+    treated as not yet published.
+
+    A lookup that fails (or is not made because max_lookups was reached) leaves a
+    hole the binary search cannot see past, so once a query runs into one it falls
+    back to scanning every work, and degraded is set: the answer is the best one from
+    the dates that are known, and may be wrong."""
+
+    def __init__(self, works, length=None, resolve_date=None, max_lookups=RELEASE_INDEX_MAX_LOOKUPS, cached_date=None):
+        by_position = {}
+
+        for work in works:
+            position = parse_position(work["position"])
+
+            if position is None or position < 1 or position != int(position):
+                continue
+
+            if length is not None and position > int(length):
+                continue
+
+            by_position.setdefault(position, work)
+
+        self.works = [by_position[position] for position in sorted(by_position)]
+        self.published = [work["published"] for work in self.works]
+        self.lookups = 0
+        self._dates = [parse_date(published) for published in self.published]
+        self._resolved = [published is not None for published in self.published]
+        self._failed = [False] * len(self.works)
+        self._resolve_date = resolve_date
+        self._cached_date = cached_date
+        self._max_lookups = max_lookups
+
+        if all(self._resolved):
+            order = sorted(range(len(self.works)), key=lambda i: (self._dates[i] is None, self._dates[i] or 0))
+            self.works = [self.works[i] for i in order]
+            self.published = [self.published[i] for i in order]
+            self._dates = [self._dates[i] for i in order]
+
+    def __len__(self):
+        return len(self.works)
+
+    @property
+    def degraded(self):
+        """ True if a date lookup a query needed failed."""
+        return any(self._failed)
+
+    def date_at(self, i):
+        """ Returns the publication date of the i-th work, resolving it if needed.
+        Returns None if the date is not known."""
+        if not self._resolved[i]:
+            self._resolved[i] = True
+            title = self.works[i]["title"]
+
+            if self._resolve_date and 'untitled' not in title.lower():
+                published = self._cached_date(title) if self._cached_date else None
+
+                if published is None and self.lookups < self._max_lookups:
+                    self.lookups += 1
+                    published = self._resolve_date(title)
+
+                if published is not None:
+                    self.published[i] = published
+                    self._dates[i] = parse_date(published)
+
+                self._failed[i] = self._dates[i] is None
+
+        return self._dates[i]
+
+    def _is_before(self, i, date):
+        """ Returns True if the i-th work came out before date; unknown dates never do."""
+        pdate = self.date_at(i)
+        return pdate is not None and pdate < date
+
+    def _is_on_or_before(self, i, date):
+        """ Returns True if the i-th work came out on or before date."""
+        pdate = self.date_at(i)
+        return pdate is not None and pdate <= date
+
+    def _scan(self, matches, latest):
+        """ Returns the position in the index of the earliest (or latest) work whose
+        known date matches, looking at every work, or None if there is none."""
+        found = [i for i in range(len(self.works)) if self.date_at(i) is not None and matches(self._dates[i])]
+
+        if not found:
+            return None
+
+        return (max if latest else min)(found, key=lambda i: (self._dates[i], i))
+
+    def latest_on_or_before(self, date):
+        """ Returns (work, published) for the most recent work published on or before
+        date, or None if there is none."""
+        low, high = 0, len(self.works)
+
+        while low < high:  # first work published after date
+            mid = (low + high) // 2
+
+            if self._is_on_or_before(mid, date):
+                low = mid + 1
+
+            else:
+                high = mid
+
+        if self.degraded:
+            i = self._scan(lambda pdate: pdate <= date, latest=True)
+            return None if i is None else (self.works[i], self.published[i])
+
+        if low == 0:
+            return None
+
+        return (self.works[low - 1], self.published[low - 1])
+
+    def first_between(self, start, end):
+        """ Returns (work, published) for the first work published between start and
+        end (inclusive), or None if there is none."""
+        low, high = 0, len(self.works)
+
+        while low < high:  # first work published on or after start
+            mid = (low + high) // 2
+
+            if self._is_before(mid, start):
+                low = mid + 1
+
+            else:
+                high = mid
+
+        if self.degraded:
+            i = self._scan(lambda pdate: start <= pdate <= end, latest=False)
+            return None if i is None else (self.works[i], self.published[i])
+
+        if low == len(self.works):
+            return None
+
+        pdate = self.date_at(low)
+
+        if pdate is None or pdate > end:
+            return None
+
+        return (self.works[low], self.published[low])
@@ -1,6 +1,6 @@
 """ Data to seed database for testing"""
 
-from model import User, Author, Fav_Author, Series, Fav_Series
+from model import User, Author, Fav_Author, Series, Fav_Series, Book, Series_Work, Series_Result
 from model import connect_to_db, db
 from server import app
 from werkzeug.security import generate_password_hash
@@ -71,6 +71,9 @@ if __name__ == "__main__":
     db.create_all()
 
     # deleting info here in a specific order to avoid foreign key errors
+    Series_Result.query.delete()
+    Series_Work.query.delete()
+    Book.query.delete()
     Fav_Series.query.delete()
     Fav_Author.query.delete()
     User.query.delete()
@@ -0,0 +1,194 @@
+""" Stores series works in the database so series can be answered without Goodreads """
+import json
+import hashlib
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+import upstream_util
+from model import db, Book, Series_Work, Series_Result
+from goodreads_util import get_series_info, get_series_ttl
+from server_util import normalize_pub_date, format_pub_date
+
+
+def is_stale(series, series_info):
+    """ Returns True if the works stored for the series need to be refreshed. How long
+    they stay fresh depends on the works themselves (see get_series_ttl)."""
+    if series.works_updated_at is None:
+        return True
+
+    max_age = timedelta(seconds=get_series_ttl(series_info))
+    return datetime.now() - series.works_updated_at > max_age
+
+
+def get_stored_series_info(series):
+    """ Given a Series, returns its info in the same format as get_series_info.
+    Stored works are used while fresh; otherwise they are refreshed from Goodreads.
+    If Goodreads fails, stale stored works are used if there are any, and a stale
+    cached copy of the Goodreads info is used but not stored, so it is not taken for
+    fresh. Returns None if there is no info to be had."""
+    stored_info = build_series_info(series) if series.works_updated_at else None
+
+    if stored_info is not None and not is_stale(series, stored_info):
+        return stored_info
+
+    series_info, stale = upstream_util.call_tracking_stale(get_series_info, series.goodreads_id)
+
+    if series_info is None:  # could not refresh, so use what we have
+        if stored_info is not None:
+            upstream_util.mark_stale()
+
+        return stored_info
+
+    if stale:
+        return series_info
+
+    save_series_info(series, series_info)
+    return build_series_info(series)
+
+
+def get_series_info_version(series_info):
+    """ Returns a short hash of the content of a series info dictionary, which changes
+    whenever the series description, length or works do."""
+    content = json.dumps(series_info, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+def build_series_info(series):
+    """ Builds the series info dictionary from the rows stored for a series."""
+    works = []
+
+    for series_work in series.works:
+        book = series_work.book
+        works.append({"title": book.title,
+                      "published": format_pub_date(book.pub_date, book.pub_date_precision),
+                      "author": book.author_name,
+                      "cover": book.cover_url,
+                      "position": series_work.position,
+                      "work_id": book.goodreads_work_id,
+                      "author_id": book.author_goodreads_id})
+
+    return {"description": series.description or "",
+            "length": str(series.work_count) if series.work_count is not None else str(len(works)),
+            "works": works}
+
+
+def save_series_info(series, series_info):
+    """ Stores the works in series_info for the series, only writing rows whose
+    values changed. Dates found earlier through Google Books are kept when Goodreads
+    still does not have one. If another process stores the same book or series work
+    first, the save is retried with its rows."""
+    try:
+        write_series_info(series, series_info)
+
+    except IntegrityError:
+        db.session.rollback()
+        write_series_info(series, series_info)
+
+
+def write_series_info(series, series_info):
+    """ Does the work of save_series_info, committing the changes."""
+    by_work_id = {}
+
+    for series_work in series.works:
+        work_id = series_work.book.goodreads_work_id
+
+        if work_id in by_work_id:  # stored twice, e.g. by two workers at once
+            db.session.delete(series_work)
+
+        else:
+            by_work_id[work_id] = series_work
+
+    seen = set()
+
+    for work in series_info["works"]:
+        if work["work_id"] in seen:  # listed twice; the first listing wins
+            continue
+
+        seen.add(work["work_id"])
+        series_work = by_work_id.get(work["work_id"])
+
+        if series_work is None:
+            book = Book.query.filter_by(goodreads_work_id=work["work_id"]).first() if work["work_id"] else None
+
+            if book is None:
+                book = Book(goodreads_work_id=work["work_id"], title=work["title"])
+                db.session.add(book)
+
+            series_work = Series_Work(series=series, book=book)
+            db.session.add(series_work)
+
+        book = series_work.book
+        pdate, precision = normalize_pub_date(work["published"])
+        values = {"title": work["title"], "author_name": work["author"], "author_goodreads_id": work["author_id"],
+                  "cover_url": work["cover"]}
+
+        if pdate is not None:
+            values["pub_date"] = pdate
+            values["pub_date_precision"] = precision
+
+        for column, value in values.items():
+            if getattr(book, column) != value:
+                setattr(book, column, value)
+
+        if series_work.position != work["position"]:
+            series_work.position = work["position"]
+
+    for work_id, series_work in by_work_id.items():  # works no longer in the series
+        if work_id not in seen:
+            db.session.delete(series_work)
+
+    series.description = series_info["description"]
+    series.work_count = int(series_info["length"])
+    series.works_updated_at = datetime.now()
+    db.session.commit()
+
+
+def save_resolved_dates(series, dates):
+    """ Stores publication dates found through Google Books for works of the series,
+    so they do not have to be looked up again. dates is a dictionary of
+    {goodreads work id: date string}; strings that are not dates are ignored."""
+    changed = False
+
+    for series_work in series.works:
+        book = series_work.book
+        pdate, precision = normalize_pub_date(dates.get(book.goodreads_work_id))
+
+        if pdate is not None and book.pub_date is None:
+            book.pub_date = pdate
+            book.pub_date_precision = precision
+            changed = True
+
+    if changed:
+        db.session.commit()
+
+
+def get_precomputed_result(series, day, timeframe):
+    """ Returns the result tuple precomputed for the series, day and timeframe (in
+    days), or None if there is none, or the works of the series were refreshed since
+    it was computed."""
+    result = Series_Result.query.filter_by(series_id=series.series_id, timeframe=timeframe, search_date=day).first()
+
+    if result is None:
+        return None
+
+    if series.works_updated_at is not None and result.computed_at < series.works_updated_at:
+        return None
+
+    return (result.title, result.published, result.cover)
+
+
+def save_precomputed_result(series, day, timeframe, results):
+    """ Stores the result tuple for the series, day and timeframe (in days), replacing
+    the one stored for an earlier day."""
+    result = Series_Result.query.filter_by(series_id=series.series_id, timeframe=timeframe).first()
+
+    if result is None:
+        result = Series_Result(series_id=series.series_id, timeframe=timeframe)
+        db.session.add(result)
+
+    result.search_date = day
+    result.title, result.published, result.cover = results
+    result.computed_at = datetime.now()
+    db.session.commit()
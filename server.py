@@ -1,23 +1,34 @@
 """ Server functionality for app  """
 import os
-import requests
-import wikipedia
+import json
+import time
 
-from flask import Flask, session, request, render_template, redirect, flash, jsonify
+from functools import wraps
+
+from flask import (Flask, Response, session, request, render_template, redirect, flash, jsonify,
+                   stream_with_context)
 from flask_mail import Mail, Message
-from rauth import OAuth1Service, OAuth1Session
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from google_util import get_pub_date_with_book_id, google_books_key, get_pub_date_with_title
-from server_util import strip_tags, convert_string_to_datetime
+import cache_util
+import upstream_util
+from google_util import (get_pub_date_with_book_id, google_books_key, get_pub_date_with_title,
+                         get_pub_dates_with_book_ids, title_date_cache, volume_date_cache,
+                         GOOGLE_BOOKS_HEDGING)
+from cache_util import make_cache
+from server_util import convert_string_to_datetime, run_concurrently, iter_concurrently
 from goodreads_util import (ET, goodreads_key, get_author_goodreads_info, get_series_list_by_author,
-                            sort_series, get_last_book_of_series, get_info_for_work)
+                            sort_series, get_last_book_of_series, series_cache, author_series_cache,
+                            author_cache, unknown_author_cache, normalize_author_name)
+from series_util import (get_stored_series_info, save_resolved_dates, get_precomputed_result,
+                         get_series_info_version)
+from calendar_util import get_releases_between, release_to_dict
+from warmup_util import CACHE_WARMUP, start_warmup, get_progress
 from model import connect_to_db, User, Author, Fav_Author, Series, Fav_Series, db
 
 # code for debugging purposes
-from flask_debugtoolbar import DebugToolbarExtension
-from jinja2 import StrictUndefined
+from jinja2 import StrictUndefined, FileSystemBytecodeCache
 
 
 app = Flask(__name__)
@@ -38,18 +49,8 @@ app.secret_key = os.environ["FLASK_SECRET_KEY"]
 mail = Mail(app)
 
 
-goodreads = OAuth1Service(
-    consumer_key=goodreads_key,
-    consumer_secret=os.environ["GOODREADS_API_SECRET"],
-    name='goodreads',
-    request_token_url='https://www.goodreads.com/oauth/request_token',
-    authorize_url='https://www.goodreads.com/oauth/authorize',
-    access_token_url='https://www.goodreads.com/oauth/access_token',
-    base_url='https://www.goodreads.com/'
-    )
-
-request_token, request_token_secret = goodreads.get_request_token(header_auth=True)
-authorizaton_url = goodreads.get_authorize_url(request_token)
+# created on first use, since importing rauth is slow and most requests never need it
+goodreads = None
 
 # dictionary in format of (days, what option is called)
 timeframes = {183: "First Book to be Published in Next Six Months", 365: "First Book to be Published in Next Year",
@@ -58,6 +59,68 @@ timeframes = {183: "First Book to be Published in Next Six Months", 365: "First
 no_cover_img = "https://d298d76i4rjz9u.cloudfront.net/assets/no-cover-art-found-c49d11316f42a2f9ba45f46cfe0335bbbc75d97c797ac185cdb397a6a7aad78c.jpg"
 no_results_img = "http://sendmeglobal.net/images/404.png"
 
+# Wikipedia summaries and images for the author pages
+wikipedia_cache = make_cache("wikipedia", int(os.environ.get("WIKIPEDIA_CACHE_BYTES", 1024 * 1024)))
+wikipedia_cache_ttl = int(os.environ.get("WIKIPEDIA_CACHE_TTL", 7 * 24 * 60 * 60))
+wikipedia_host = "https://en.wikipedia.org"
+# the wikipedia library makes its requests without a timeout, so calls are given up on after this long
+wikipedia_timeout = float(os.environ.get("WIKIPEDIA_TIMEOUT", 10))
+
+# final search results, keyed by what was searched, the day and the timeframe. Series results
+# are also keyed by a hash of the series info, so they are dropped once the series changes;
+# author results only expire
+search_cache = make_cache("search_results", int(os.environ.get("SEARCH_CACHE_BYTES", 2 * 1024 * 1024)))
+series_search_cache_ttl = int(os.environ.get("SERIES_SEARCH_CACHE_TTL", 24 * 60 * 60))
+author_search_cache_ttl = int(os.environ.get("AUTHOR_SEARCH_CACHE_TTL", 60 * 60))
+
+# seconds each request may spend on upstream calls, altogether
+request_deadline = float(os.environ.get("REQUEST_DEADLINE", 10))
+
+# limits for the Google Books lookups made while building a series page
+series_page_max_workers = int(os.environ.get("SERIES_PAGE_MAX_WORKERS", 6))
+series_page_deadline = float(os.environ.get("SERIES_PAGE_DEADLINE", 8))
+
+# limits for /search-batch.json: targets per batch, searches run at once, and seconds allowed
+batch_max_targets = int(os.environ.get("BATCH_MAX_TARGETS", 30))
+batch_max_workers = int(os.environ.get("BATCH_MAX_WORKERS", 4))
+batch_deadline = float(os.environ.get("BATCH_DEADLINE", 20))
+
+
+@app.before_request
+def start_request():
+    """ Sets up the request-scoped upstream state."""
+    upstream_util.track_stale()
+    upstream_util.set_deadline(None)
+
+
+@app.teardown_request
+def end_request(exception=None):
+    """ Clears the request deadline, so it does not linger in the thread."""
+    upstream_util.set_deadline(None)
+
+
+def with_deadline(seconds=None):
+    """ Route decorator giving the request seconds (request_deadline by default) for
+    all of its upstream calls, including those made from worker threads. Calls made
+    once the time is up fail right away, as if the upstream had timed out."""
+    def decorator(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            upstream_util.set_deadline(seconds or request_deadline)
+            return route(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def mark_timeout(results):
+    """ Adds the reason to an error result if the request ran out of time."""
+    if results.get("status") == "error" and upstream_util.deadline_exceeded():
+        results["reason"] = "timeout"
+
+    return results
+
 
 @app.route("/")
 def show_homepage():
@@ -82,6 +145,7 @@ def show_search():
 
 
 @app.route("/search.json", methods=["POST"])
+@with_deadline()
 def search_json():
     """ Returns search results based off author or series inputted"""
     author = request.form.get("author")
@@ -95,92 +159,348 @@ def search_json():
     td = timedelta(days=timeframe)
 
     if author:
-        payload = {"q": "inauthor:" + author,
-                   "langRestrict": "en",
-                   "orderBy": "newest",
-                   "printType": "books",
-                   "key": google_books_key
-                   }
+        results = get_author_search_results(author, py_date, td)
+        searched = author
 
-        response = requests.get("https://www.googleapis.com/books/v1/volumes", params=payload)
+    else:  # if series is being searched
+        series = Series.query.get(series_id)
+        results = get_series_search_results(series, py_date, td)
+        searched = series.series_name
 
-        if response.status_code == 200:
-            results = response.json()
-            next_book = results["items"][0]["volumeInfo"]
-            next_book_cover = no_cover_img
+    if upstream_util.served_stale():
+        results["stale"] = True
+
+    mark_timeout(results)
 
-            if results["items"][0]["volumeInfo"].get("imageLinks"):
-                next_book_cover = results["items"][0]["volumeInfo"]["imageLinks"]["thumbnail"]
+    if "search_history" in session and results["status"] == "ok":
+        search = (date, tf_str, searched, results["results"])
+        # this looks redundant, but if I try to modify the session value directly
+        # it doesn't update, so it has to be like this
+        s_history = session["search_history"]
+        s_history.append(search)
+        session["search_history"] = s_history
 
-            next_book_id = results["items"][0]["id"]
+    return jsonify(results)
 
-            published_date = get_pub_date_with_book_id(next_book_id)
 
-            if published_date == "error":
-                return jsonify({"status": "error"})
+def get_author_search_results(author, py_date, td, results=None):
+    """ Returns a dictionary with the book by author found for the date and timeframe
+    given, in the same format as search_json's response. Results are shared through
+    search_cache. results, the response of search_author_books, can be passed in if
+    it was already fetched."""
+    key = "author:{}:{}:{}".format(normalize_author_name(author), py_date.date(), td.days)
+    return memoize_search(key, author_search_cache_ttl,
+                          lambda: compute_author_search_results(author, py_date, td, results))
 
-            pdate = convert_string_to_datetime(published_date)
 
-            result = ("Title: <i>{}</i>".format(next_book["title"]), "Publication date: {}".format(published_date), next_book_cover)
+def search_author_books(author):
+    """ Returns the Google Books search response for the newest books by author, or
+    None if the search failed."""
+    payload = {"q": "inauthor:" + author,
+               "langRestrict": "en",
+               "orderBy": "newest",
+               "printType": "books",
+               "fields": "items(id,volumeInfo(title,imageLinks/thumbnail))",
+               "key": google_books_key
+               }
+
+    response = upstream_util.get("https://www.googleapis.com/books/v1/volumes", params=payload,
+                                 hedge=GOOGLE_BOOKS_HEDGING)
+
+    if response.status_code == 200:
+        return response.json()
+
+    return None
+
+
+def compute_author_search_results(author, py_date, td, results=None):
+    """ Works out the result of get_author_search_results from Google Books, searching
+    for the author's books unless results are given. If the date of a book that might
+    have been the answer could not be looked up, the result has degraded set to True."""
+    if results is None:
+        results = search_author_books(author)
+
+    if results is not None:
+        next_book = results["items"][0]["volumeInfo"]
+        next_book_cover = no_cover_img
+
+        if results["items"][0]["volumeInfo"].get("imageLinks"):
+            next_book_cover = results["items"][0]["volumeInfo"]["imageLinks"]["thumbnail"]
+
+        next_book_id = results["items"][0]["id"]
+
+        published_date = get_pub_date_with_book_id(next_book_id)
+
+        if published_date == "error":
+            return {"status": "error"}
+
+        pdate = convert_string_to_datetime(published_date)
+
+        result = ("Title: <i>{}</i>".format(next_book["title"]), "Publication date: {}".format(published_date), next_book_cover)
+        degraded = False
+
+        if (not td) and not (pdate <= py_date):
+            other_works = results["items"][1:]
+            other_dates = get_pub_dates_with_book_ids(work["id"] for work in other_works)
+
+            for work, date2 in zip(other_works, other_dates):
+                if date2 == "error":
+                    degraded = True
+                    continue
+
+                pdate2 = convert_string_to_datetime(date2)
+                next_book_cover2 = no_cover_img
+
+                if work["volumeInfo"].get("imageLinks"):
+                    next_book_cover2 = work["volumeInfo"]["imageLinks"]["thumbnail"]
+
+                if (pdate2 <= py_date):
+                    result = ("Title: <i>{}</i>".format(work["volumeInfo"]["title"]), "Publication date: {}".format(date2), next_book_cover2)
+                    break
+
+        if td and not (py_date <= pdate <= py_date + td):
+            if pdate < py_date:
+                result = (None, None, no_results_img)
+            else:
+                other_works = results["items"][1:]
+                other_dates = get_pub_dates_with_book_ids(work["id"] for work in other_works)
+
+                for work, date2 in zip(other_works, other_dates):
+                    if date2 == "error":
+                        degraded = True
+                        continue
 
-            if (not td) and not (pdate <= py_date):
-                for work in results["items"][1:]:
-                    date2 = get_pub_date_with_book_id(work["id"])
                     pdate2 = convert_string_to_datetime(date2)
                     next_book_cover2 = no_cover_img
 
                     if work["volumeInfo"].get("imageLinks"):
                         next_book_cover2 = work["volumeInfo"]["imageLinks"]["thumbnail"]
 
-                    if (pdate2 <= py_date):
+                    if pdate2 < py_date:
+                        result = (None, None, no_results_img)
+                        break
+
+                    elif py_date <= pdate2 <= py_date + td:
                         result = ("Title: <i>{}</i>".format(work["volumeInfo"]["title"]), "Publication date: {}".format(date2), next_book_cover2)
                         break
 
-            if td and not (py_date <= pdate <= py_date + td):
-                if pdate < py_date:
-                    result = (None, None, no_results_img)
-                else:
-                    for work in results["items"][1:]:
-                        date2 = get_pub_date_with_book_id(work["id"])
-                        pdate2 = convert_string_to_datetime(date2)
-                        next_book_cover2 = no_cover_img
+        if degraded:
+            return {"status": "ok", "results": result, "degraded": True}
+
+        return {"status": "ok", "results": result}
+
+    return {"status": "error"}
+
+
+def get_series_search_results(series, py_date, td):
+    """ Returns a dictionary with the book of the series found for the date and
+    timeframe given, in the same format as search_json's response. Answered from
+    the results precomputed for the day if there are any (see precompute.py)."""
+    precomputed = get_precomputed_result(series, py_date.date(), td.days)
+
+    if precomputed is not None:
+        return {"status": "ok", "results": precomputed}
+
+    return compute_series_search_results(series, py_date, td)
+
+
+def compute_series_search_results(series, py_date, td):
+    """ Works out the result of get_series_search_results from the series info. Results
+    are shared through search_cache for as long as the series info stays the same."""
+    series_info = get_stored_series_info(series)
+
+    def compute():
+        return get_last_book_of_series(series.series_name, series.goodreads_id, py_date, td, series_info)
+
+    if series_info is None:
+        return compute()
 
-                        if work["volumeInfo"].get("imageLinks"):
-                            next_book_cover2 = work["volumeInfo"]["imageLinks"]["thumbnail"]
+    key = "series:{}:{}:{}:{}".format(series.series_id, py_date.date(), td.days, get_series_info_version(series_info))
+    return memoize_search(key, series_search_cache_ttl, compute)
 
-                        if pdate2 < py_date:
-                            result = (None, None, no_results_img)
-                            break
 
-                        elif py_date <= pdate2 <= py_date + td:
-                            result = ("Title: <i>{}</i>".format(work["volumeInfo"]["title"]), "Publication date: {}".format(date2), next_book_cover2)
-                            break
+def memoize_search(key, ttl, compute):
+    """ Returns the search result cached under key, or compute()'s result, which is
+    cached if the search worked, used no stale data and is not degraded (worked out
+    without a publication date it needed)."""
+    results = search_cache.get(key)
 
-            if "search_history" in session:
-                search = (date, tf_str, author, result)
-                # this looks redundant, but if I try to modify the session value directly
-                # it doesn't update, so it has to be like this
-                s_history = session["search_history"]
-                s_history.append(search)
-                session["search_history"] = s_history
+    if results is not None:
+        return dict(results)
 
-            return jsonify({"status": "ok", "results": result})
+    results = compute()
+
+    if results["status"] == "ok" and not results.get("degraded") and not upstream_util.served_stale():
+        search_cache.set(key, dict(results), ttl)
+
+    return results
+
+
+@app.route("/search-batch.json", methods=["POST"])
+@with_deadline(batch_deadline)
+def search_batch_json():
+    """ Returns search results for several series and authors at once. Series ids and
+    author names can be given as lists; if neither is given, the logged-in user's
+    favorite series and authors are searched. Searches run concurrently; any not
+    finished within the batch deadline come back with status error and reason
+    timeout, and any that raised with status error."""
+    timeframe = int(request.form.get("timeframe"))
+    tf_str = timeframes[timeframe]
+
+    date = request.form.get("date")
+    date_str = " ".join(date.split()[1:])
+    py_date = datetime.strptime(date_str, "%b %d %Y")
+    td = timedelta(days=timeframe)
 
+    targets = get_batch_targets(request.form.getlist("series"), request.form.getlist("author"))
+
+    if not targets:
         return jsonify({"status": "error"})
 
-    else:  # if series is being searched
+    results = run_concurrently(lambda target: search_target(target, py_date, td), targets, batch_max_workers,
+                               timeout=upstream_util.remaining_time(batch_deadline),
+                               default={"status": "error", "reason": "timeout"}, error={"status": "error"})
+
+    for target, result in zip(targets, results):
+        target.update(result)
+
+    return jsonify({"status": "ok", "timeframe": tf_str, "results": targets})
+
+
+@app.route("/search-batch.stream")
+@with_deadline(batch_deadline)
+def search_batch_stream():
+    """ Streams batch search results as Server-Sent Events. Takes the same values as
+    /search-batch.json, as query string arguments. Each target is sent as a result
+    event as soon as its search finishes, followed by one summary event."""
+    timeframe = int(request.args.get("timeframe"))
+    tf_str = timeframes[timeframe]
+
+    date = request.args.get("date")
+    date_str = " ".join(date.split()[1:])
+    py_date = datetime.strptime(date_str, "%b %d %Y")
+    td = timedelta(days=timeframe)
+
+    targets = get_batch_targets(request.args.getlist("series"), request.args.getlist("author"))
+    started = time.time()
+
+    def generate():
+        found = 0
+        results = iter_concurrently(lambda target: search_target(target, py_date, td), targets, batch_max_workers,
+                                    timeout=upstream_util.remaining_time(batch_deadline),
+                                    default={"status": "error", "reason": "timeout"}, error={"status": "error"})
+
+        for i, result in results:
+            target = dict(targets[i], **result)
+            found += target["status"] == "ok"
+            yield format_event("result", target)
+
+        yield format_event("summary", {"status": "ok", "timeframe": tf_str, "total": len(targets), "ok": found,
+                                       "errors": len(targets) - found, "seconds": round(time.time() - started, 3)})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # tells nginx not to buffer events
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
+def format_event(event, data):
+    """ Formats a Server-Sent Event with a JSON payload."""
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+def get_batch_targets(series_ids, authors):
+    """ Returns the deduplicated list of searches to run for a batch, as dictionaries
+    with type (series or author), id and name. Falls back to the logged-in user's
+    favorites when no series or authors are given."""
+    if not series_ids and not authors and "user_id" in session:
+        user = User.query.get(session["user_id"])
+
+        if user:
+            series_ids = [fav.series_id for fav in user.fav_series]
+            authors = [fav.author.author_name for fav in user.fav_authors]
+
+    targets = []
+    seen = set()
+
+    for series_id in series_ids:
         series = Series.query.get(series_id)
-        results = get_last_book_of_series(series.series_name, series.goodreads_id, py_date, td)
 
-        if "search_history" in session:
-            search = (date, tf_str, series.series_name, results["results"])
-            # this looks redundant, but if I try to modify the session value directly
-            # it doesn't update, so it has to be like this
-            s_history = session["search_history"]
-            s_history.append(search)
-            session["search_history"] = s_history
+        if series and series.series_id not in seen:
+            seen.add(series.series_id)
+            targets.append({"type": "series", "id": series.series_id, "name": series.series_name})
 
-        return jsonify(results)
+    for author in authors:
+        author_key = " ".join(author.lower().split())
+
+        if author_key and author_key not in seen:
+            seen.add(author_key)
+            targets.append({"type": "author", "id": None, "name": author.strip()})
+
+    return targets[:batch_max_targets]
+
+
+def search_target(target, py_date, td):
+    """ Runs the search for one batch target. Meant to be run in a worker thread, so
+    it sets up its own app context for database access. Staleness is tracked per
+    target."""
+    upstream_util.track_stale()
+
+    with app.app_context():
+        if target["type"] == "author":
+            result = get_author_search_results(target["name"], py_date, td)
+
+        else:
+            series = Series.query.get(target["id"])
+            result = get_series_search_results(series, py_date, td)
+
+    if upstream_util.served_stale():
+        result["stale"] = True
+
+    return mark_timeout(result)
+
+
+@app.route("/releases.json")
+def releases_json():
+    """ Returns the stored books published between the start and end dates given
+    (YYYY-MM-DD), in date order and a page at a time. If favorites is 1, only books
+    from the logged-in user's favorite series and authors are returned."""
+    try:
+        start = datetime.strptime(request.args.get("start", ""), "%Y-%m-%d").date()
+        end = datetime.strptime(request.args.get("end", ""), "%Y-%m-%d").date()
+        page = int(request.args.get("page", 1))
+    except ValueError:
+        return jsonify({"status": "error"})
+
+    user_id = None
+
+    if request.args.get("favorites") == "1":
+        user_id = session.get("user_id")
+
+        if user_id is None:
+            return jsonify({"status": "error"})
+
+    releases = get_releases_between(start, end, user_id, page)
+
+    return jsonify({"status": "ok",
+                    "results": [release_to_dict(*release) for release in releases.items],
+                    "page": releases.page,
+                    "pages": releases.pages,
+                    "has_next": releases.has_next})
+
+
+@app.route("/upstream-stats.json")
+def upstream_stats_json():
+    """ Returns the state of the upstream circuit breakers, hedging and rate limits,
+    including how many calls are queued for a Goodreads token and how long they wait,
+    and the hits, misses and evictions of each cache."""
+    stats = upstream_util.get_stats()
+    stats["caches"] = cache_util.get_stats()
+    return jsonify(stats)
+
+
+@app.route("/warmup-status.json")
+def warmup_status_json():
+    """ Returns the progress of this worker's cache warm-up (see warmup_util)."""
+    return jsonify(get_progress())
 
 
 @app.route("/email-info.json", methods=["POST"])
@@ -206,6 +526,7 @@ def show_adv_search():
 
 
 @app.route("/by-author", methods=["POST"])
+@with_deadline()
 def search_by_author():
     """ Returns list of series associated with author"""
     author_name = request.form.get("author")
@@ -283,13 +604,14 @@ def search_by_author():
 
 
 @app.route("/by-book", methods=["POST"])
+@with_deadline()
 def search_by_book():
     """ Returns search results based off book title"""
     title = request.form.get("title")
 
     payload = {"q": title, "key": goodreads_key}
 
-    response = requests.get("https://www.goodreads.com/search/index.xml", params=payload)
+    response = upstream_util.get("https://www.goodreads.com/search/index.xml", params=payload)
 
     if response.status_code == 200:  # got a response
         tree = ET.fromstring(response.content)
@@ -314,6 +636,7 @@ def search_by_book():
 
 
 @app.route("/book-series", methods=["POST"])
+@with_deadline()
 def series_by_books():
     """ Shows series linked to book """
     book_info = request.form.get("book").split("||")
@@ -325,7 +648,7 @@ def series_by_books():
     if book_id:
         payload = {"key": goodreads_key}
         url = "https://www.goodreads.com/work/{}/series".format(book_id)
-        response = requests.get(url, params=payload)
+        response = upstream_util.get(url, params=payload)
 
         if response.status_code == 200:
             tree = ET.fromstring(response.content)
@@ -347,6 +670,7 @@ def series_by_books():
 
 
 @app.route("/series-result.json", methods=["POST"])
+@with_deadline()
 def show_series_results():
     """ Returns last book of series """
     series_id = request.form.get("id")
@@ -361,9 +685,21 @@ def show_series_results():
     td = timedelta(days=timeframe)
 
     if series_id and series_name:  # if there is a series id and name
-        results = get_last_book_of_series(series_name, series_id, py_date, td)
+        series = Series.query.filter_by(goodreads_id=series_id).first()
+
+        if not series:  # if series is not in database
+            series = Series(goodreads_id=series_id, series_name=series_name)
+            db.session.add(series)
+            db.session.commit()
+
+        results = get_series_search_results(series, py_date, td)
+
+        if upstream_util.served_stale():
+            results["stale"] = True
 
-        if "search_history" in session:
+        mark_timeout(results)
+
+        if "search_history" in session and results["status"] == "ok":
             search = (date, tf_str, series_name, results["results"])
             # this looks redundant, but if I try to modify the session value directly
             # it doesn't update, so it has to be like this
@@ -371,10 +707,6 @@ def show_series_results():
             s_history.append(search)
             session["search_history"] = s_history
 
-        if not Series.query.filter_by(goodreads_id=series_id).first():  # if series is not in database
-            db.session.add(Series(goodreads_id=series_id, series_name=series_name))
-            db.session.commit()
-
         return jsonify(results)
 
     else:
@@ -479,10 +811,37 @@ def show_profile(user_id):
             return redirect("/")
 
 
+def get_goodreads_service():
+    """ Returns the rauth service used for Goodreads OAuth, creating it on first use."""
+    global goodreads
+
+    if goodreads is None:
+        from rauth import OAuth1Service
+
+        goodreads = OAuth1Service(
+            consumer_key=goodreads_key,
+            consumer_secret=os.environ["GOODREADS_API_SECRET"],
+            name='goodreads',
+            request_token_url='https://www.goodreads.com/oauth/request_token',
+            authorize_url='https://www.goodreads.com/oauth/authorize',
+            access_token_url='https://www.goodreads.com/oauth/access_token',
+            base_url='https://www.goodreads.com/'
+            )
+
+    return goodreads
+
+
 @app.route("/goodreads-oauth")
 def goodreads_oauth():
-    """ Provides url needed for Goodreads OAuth """
-    return redirect(authorizaton_url)
+    """ Gets a request token for this user's OAuth flow and redirects to the Goodreads
+    authorization url for it """
+    service = get_goodreads_service()
+    request_token, request_token_secret = service.get_request_token(header_auth=True,
+                                                                    timeout=upstream_util.get_timeout())
+    # kept in the session so the callback can exchange it for an access token
+    session["gr_request_token"] = request_token
+    session["gr_request_token_secret"] = request_token_secret
+    return redirect(service.get_authorize_url(request_token))
 
 
 @app.route("/gr-oauth-authorized")
@@ -492,8 +851,12 @@ def confirm_oauth():
     user = User.query.get(session.get("user_id"))
 
     if user:
-        if authorized == "1":
-            gr_sess = goodreads.get_auth_session(request_token, request_token_secret)
+        request_token = session.pop("gr_request_token", None)
+        request_token_secret = session.pop("gr_request_token_secret", None)
+
+        if authorized == "1" and request_token:
+            gr_sess = get_goodreads_service().get_auth_session(request_token, request_token_secret,
+                                                               timeout=upstream_util.get_timeout())
             user.goodreads_access_token = gr_sess.access_token
             user.goodreads_access_token_secret = gr_sess.access_token_secret
             user.is_goodreads_authorized = True
@@ -544,6 +907,7 @@ def update_profile():
 
 
 @app.route("/update-authors", methods=["POST"])
+@with_deadline()
 def update_authors():
     """ Updates who is the user's favorites authors """
     user_id = session.get("user_id")
@@ -625,6 +989,7 @@ def update_fav_author():
 
 
 @app.route("/get-author-id.json", methods=["POST"])
+@with_deadline()
 def get_author_id():
     """ Returns author id for author name inputted """
     a_name = request.form.get("author")
@@ -648,6 +1013,9 @@ def get_author_id():
                 new_auth = Author.query.filter_by(goodreads_id=goodreads_id).first()
                 return jsonify({"auth_status": "ok", "id": new_auth.author_id})
 
+        elif upstream_util.deadline_exceeded():
+            return jsonify({"auth_status": "error", "reason": "timeout"})
+
         else:  # author is not in goodreads
             return jsonify({"auth_status": "error"})
 
@@ -725,6 +1093,7 @@ def update_fav_series():
 
 
 @app.route("/author/<author_id>")
+@with_deadline()
 def show_author_info(author_id):
     """ Renders author info page """
     author = Author.query.get(author_id)
@@ -733,17 +1102,17 @@ def show_author_info(author_id):
         series = None
 
         if author.author_img:
-            author_info = wikipedia.summary(author.author_name)
+            author_info = get_wikipedia_summary(author.author_name)
             author_info.replace("\n", " ")
             author_img = author.author_img
 
         else:
 
-            author_pg = wikipedia.page(author.author_name)
+            author_info, author_images = get_wikipedia_page(author.author_name)
             # handle any exceptions up here.
             author_img = None
 
-            for link in author_pg.images:
+            for link in author_images:
                 if author.author_name.split(" ")[-1] in link and link.endswith("jpg"):
                     author_img = link
 
@@ -751,7 +1120,6 @@ def show_author_info(author_id):
                 author.author_img = author_img
                 db.session.commit()
 
-            author_info = author_pg.summary
             author_info.replace("\n", " ")
 
         if author.goodreads_id is None:
@@ -774,6 +1142,47 @@ def show_author_info(author_id):
             return redirect("/")
 
 
+def get_wikipedia_summary(name):
+    """ Returns the summary of the Wikipedia page for name, cached."""
+    return get_from_wikipedia("summary:" + name, lambda wikipedia: wikipedia.summary(name), "")
+
+
+def get_wikipedia_page(name):
+    """ Returns (summary, image links) of the Wikipedia page for name, cached."""
+    def fetch(wikipedia):
+        page = wikipedia.page(name)
+        return (page.summary, list(page.images))
+
+    return get_from_wikipedia("page:" + name, fetch, ("", []))
+
+
+def get_from_wikipedia(key, fetch, default):
+    """ Returns fetch(wikipedia module), cached under key. If Wikipedia cannot be
+    reached (or its circuit breaker is open), the cached value is used even if stale,
+    or default if there is none, as it is if Wikipedia has not answered within
+    wikipedia_timeout seconds (or the request deadline)."""
+    entry = wikipedia_cache.get(key)
+
+    if entry is not None and entry["fresh_until"] > time.time():
+        return entry["value"]
+
+    import wikipedia  # slow to import, and only needed here
+
+    reached, value = upstream_util.call_with_breaker(wikipedia_host, lambda: fetch(wikipedia),
+                                                     timeout=upstream_util.remaining_time(wikipedia_timeout))
+
+    if reached:
+        wikipedia_cache.set(key, {"value": value, "fresh_until": time.time() + wikipedia_cache_ttl},
+                            wikipedia_cache_ttl + upstream_util.UPSTREAM_REVALIDATE_WINDOW)
+        return value
+
+    if entry is not None:
+        upstream_util.mark_stale()
+        return entry["value"]
+
+    return default
+
+
 @app.route("/goodreads-follow-author/<author_id>")
 def follow_goodreads_author(author_id):
     """ Follows author on Goodreads linked to user's account """
@@ -781,13 +1190,15 @@ def follow_goodreads_author(author_id):
     author = Author.query.get(author_id)  # check to see if author exists as well
     if user:
         if user.is_goodreads_authorized:
+            from rauth import OAuth1Session
+
             gr_sess = OAuth1Session(consumer_key=goodreads_key,
                                     consumer_secret=os.environ["GOODREADS_API_SECRET"],
                                     access_token=user.goodreads_access_token,
                                     access_token_secret=user.goodreads_access_token_secret)
 
             data = {'id': author.goodreads_id}  # check to see if goodreads id is present
-            gr_sess.post('https://www.goodreads.com/author_followings', data)
+            gr_sess.post('https://www.goodreads.com/author_followings', data, timeout=upstream_util.get_timeout())
             flash("Successfully followed {}".format(author.author_name), "success")
             return redirect("/author/{}".format(author.author_id))
 
@@ -801,42 +1212,45 @@ def follow_goodreads_author(author_id):
 
 
 @app.route("/series/<series_id>")
+@with_deadline()
 def show_series_info(series_id):
     """ Renders series info page """
     series = Series.query.get(series_id)
 
     if series:
         series_info = {}
-        payload = {"key": goodreads_key, "id": series.goodreads_id}
-        response = requests.get("https://www.goodreads.com/series/show/", params=payload)
-
-        if response.status_code == 200:
-            tree = ET.fromstring(response.content)
-            s_info = tree.find("series")
+        goodreads_info = get_stored_series_info(series)
+
+        if goodreads_info is not None:
+            series_info["description"] = goodreads_info["description"]
+            series_info["length"] = goodreads_info["length"]
+            valid_positions = set(str(i) for i in range(1, int(series_info["length"]) + 1))
+            works = [work_info for work_info in goodreads_info["works"] if work_info["position"] in valid_positions]
+
+            # titles which need a date from Google Books are looked up all at once
+            to_look_up = [work_info["title"] for work_info in works
+                          if work_info["published"] is None and 'untitled' not in work_info["title"].lower()]
+            found_dates = run_concurrently(get_pub_date_with_title, to_look_up, series_page_max_workers,
+                                           timeout=upstream_util.remaining_time(series_page_deadline),
+                                           default="Unknown")
+            found_dates = dict(zip(to_look_up, found_dates))
+            save_resolved_dates(series, {work_info["work_id"]: found_dates[work_info["title"]]
+                                         for work_info in works if work_info["title"] in found_dates})
 
-            series_info["description"] = strip_tags(s_info.find("description").text.strip())
-            series_info["length"] = s_info.find("primary_work_count").text
-            series_works = list(s_info.find("series_works"))
             series_info["works"] = []
 
-            for work in series_works:
-                valid_positions = set(str(i) for i in range(1, int(series_info["length"]) + 1))
+            for work_info in works:
+                title = work_info["title"]
+                pub_date = work_info["published"]
 
-                if work.find("user_position").text in valid_positions:
-                    work_info = get_info_for_work(work)
-                    title = work_info["title"]
-                    pub_date = work_info["published"]
-                    cover = work_info["cover"]
+                if pub_date is None:
+                    if 'untitled' in title.lower():  # if the book currently has no title
+                        pub_date = "TBA"
 
-                    if pub_date is None:
-                        if 'untitled' in title.lower():  # if the book currently has no title
-                            pub_date = "TBA"
+                    else:
+                        pub_date = found_dates[title]
 
-                        else:
-                            pub_date = get_pub_date_with_title(title)
-
-                    author = work_info["author"]
-                    series_info["works"].append((title, author, pub_date, cover))
+                series_info["works"].append((title, work_info["author"], pub_date, work_info["cover"]))
 
             if (len(series_info["works"]) != int(series_info["length"])):
                 series_info["length"] = str(len(series_info["works"]))
@@ -852,12 +1266,89 @@ def show_series_info(series_id):
         else:
             return redirect("/")
 
+
+def precompile_templates(app):
+    """ Compiles every template up front, so the bytecode cache is filled before the
+    first request instead of during it."""
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+def create_app(db_url="postgresql:///project"):
+    """ Does the startup work for the app: connects the database and sets up the
+    template cache. Kept out of import time so importing server is fast and never
+    touches the network. Set JINJA_CACHE_DIR to keep compiled templates between
+    restarts, and JINJA_PRECOMPILE=1 to compile them all at startup."""
+    connect_to_db(app, db_url)
+
+    if os.environ.get("JINJA_CACHE_DIR"):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ["JINJA_CACHE_DIR"])
+
+    if os.environ.get("JINJA_PRECOMPILE") == "1":
+        precompile_templates(app)
+
+    return app
+
+
+def init_worker():
+    """ Sets up the state each worker process must not share with the process it was
+    forked from: database connections, upstream HTTP pools and in-process caches.
+    Called by gunicorn in each worker once the app is loaded (see gunicorn.conf.py)."""
+    with app.app_context():
+        db.engine.dispose()
+
+    upstream_util.after_fork()
+
+    for cache in (series_cache, author_series_cache, author_cache, unknown_author_cache, title_date_cache,
+                  volume_date_cache, wikipedia_cache, search_cache):
+        cache.after_fork()
+
+    if CACHE_WARMUP:
+        # with a shared cache one worker warms it for all; otherwise each worker warms its own
+        start_warmup(app, warm_cache, lock_cache=search_cache if search_cache.shared else None)
+
+
+def warm_cache(kind, row):
+    """ Runs the searches for a series or author (a row from
+    warmup_util.rank_by_favorites) for today and every timeframe, so their upstream
+    data and results are cached. An author's books are searched for once, for every
+    timeframe. Returns True if every search worked."""
+    upstream_util.track_stale()
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    books = search_author_books(row.author_name) if kind == "author" else None
+    worked = kind == "series" or books is not None
+
+    for timeframe in timeframes:
+        td = timedelta(days=timeframe)
+
+        if kind == "series":
+            results = compute_series_search_results(row, today, td)
+
+        elif books is not None:
+            results = get_author_search_results(row.author_name, today, td, books)
+
+        else:
+            break
+
+        worked = worked and results["status"] == "ok"
+
+    if kind == "author" and row.goodreads_id:
+        worked = get_series_list_by_author(row.goodreads_id) is not None and worked
+
+    return worked
+
+
 if __name__ == "__main__":
     app.debug = False
     # if debugging, uncomment line below
     # app.debug = True
     app.jinja_env.auto_reload = app.debug
-    connect_to_db(app)
-    # line below is for debugging purposes
+    create_app()
+
+    if CACHE_WARMUP:
+        start_warmup(app, warm_cache)
+
+    # lines below are for debugging purposes
+    # from flask_debugtoolbar import DebugToolbarExtension
     # DebugToolbarExtension(app)
     app.run(host="0.0.0.0")
@@ -1,5 +1,8 @@
+import contextvars
+
 from html.parser import HTMLParser
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 
 
 class MLStripper(HTMLParser):
@@ -36,3 +39,78 @@ def convert_string_to_datetime(date_string):
         return datetime.strptime(date_string, "%Y-%m")
     else:
         return datetime.strptime(date_string, "%Y-%m-%d")
+
+
+def normalize_pub_date(date_string):
+    """ Given a publication date string as returned by Goodreads or Google Books,
+    returns (date, precision), where precision is year, month or day. Returns
+    (None, None) if the string is not a date (for example, error or TBA)."""
+    if not date_string:
+        return (None, None)
+
+    try:
+        pdate = convert_string_to_datetime(date_string[:10]).date()
+    except ValueError:
+        return (None, None)
+
+    precision = ["year", "month", "day"][min(date_string[:10].count("-"), 2)]
+    return (pdate, precision)
+
+
+def format_pub_date(pdate, precision):
+    """ Turns a date and its precision back into the string format used by
+    Goodreads and Google Books (YYYY, YYYY-MM or YYYY-MM-DD)."""
+    if pdate is None:
+        return None
+
+    if precision == "year":
+        return pdate.strftime("%Y")
+
+    elif precision == "month":
+        return pdate.strftime("%Y-%m")
+
+    return pdate.strftime("%Y-%m-%d")
+
+
+def run_concurrently(func, args_list, max_workers, timeout=None, default=None, error=None):
+    """ Calls func with each item of args_list, using at most max_workers threads.
+    Returns a list of the results in the same order as args_list. Any call that had
+    not finished after timeout seconds gets default as its result, and any call that
+    raised gets error (or default, if error is None)."""
+    results = [default] * len(args_list)
+
+    for i, result in iter_concurrently(func, args_list, max_workers, timeout, default, error):
+        results[i] = result
+
+    return results
+
+
+def iter_concurrently(func, args_list, max_workers, timeout=None, default=None, error=None):
+    """ Like run_concurrently, but yields (index, result) pairs as soon as each call
+    finishes. Calls that had not finished after timeout seconds are yielded last,
+    with default as their result."""
+    if not args_list:
+        return
+
+    error = default if error is None else error
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(args_list))))
+    # each call runs in a copy of the caller's context, so request-scoped state carries over
+    futures = {executor.submit(contextvars.copy_context().run, func, arg): i for i, arg in enumerate(args_list)}
+    pending = set(futures)
+
+    try:
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                pending.discard(future)
+                yield futures[future], future.result() if future.exception() is None else error
+
+        except FuturesTimeoutError:
+            pass
+
+        for future in sorted(pending, key=futures.get):
+            future.cancel()  # don't start calls nobody will wait for
+            yield futures[future], default
+
+    finally:
+        executor.shutdown(wait=False)
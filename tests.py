@@ -2,16 +2,35 @@
 
 from unittest import TestCase, main
 import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-from unittest.mock import patch
+from datetime import datetime, timedelta, date
+from unittest.mock import patch, MagicMock
+from tempfile import TemporaryDirectory
+import os
+import json
+import time
+from threading import Event, Thread
 from flask import session
 
-from server import app
-from model import connect_to_db, db, example_data
+from server import app, wikipedia_cache, search_cache, timeframes, warm_cache, get_author_search_results
+from series_util import save_precomputed_result, get_precomputed_result, save_series_info, get_stored_series_info
+from precompute import precompute_all
+from warmup_util import run_warmup, get_progress
+from model import connect_to_db, db, example_data, Series, Book, Series_Work, Author, Fav_Author
 from goodreads_util import (sort_series, get_info_for_work, get_author_goodreads_info,
-                            get_series_list_by_author, get_last_book_of_series)
-from google_util import get_pub_date_with_book_id, get_pub_date_with_title
-from server_util import convert_string_to_datetime, strip_tags
+                            get_series_list_by_author, get_last_book_of_series, get_series_info,
+                            get_series_ttl, series_cache, author_series_cache, SERIES_TTL_MIN, SERIES_TTL_MAX,
+                            SERIES_CACHE_TTL, author_cache, unknown_author_cache, normalize_author_name)
+from google_util import (get_pub_date_with_book_id, get_pub_date_with_title, get_pub_dates_with_book_ids,
+                         title_date_cache, volume_date_cache)
+from release_util import SeriesReleaseIndex, parse_position
+from server_util import (convert_string_to_datetime, strip_tags, run_concurrently, normalize_pub_date,
+                         format_pub_date)
+from cache_util import LRUCache, SQLiteCache, RedisCache, LocalRedis
+from ratelimit_util import (RateLimiter, PriorityScheduler, priority, get_priority, INTERACTIVE,
+                            BACKGROUND)
+from keypool_util import KeyPool, get_keys
+import upstream_util
+import requests
 
 
 class ServerUtilTests(TestCase):
@@ -38,40 +57,632 @@ class ServerUtilTests(TestCase):
         test_str = "BOO"
         self.assertEqual(strip_tags(test_str), test_str)
 
+    def test_normalize_pub_date(self):
+        """ Tests to see if date strings are turned into a date and its precision"""
+        self.assertEqual(normalize_pub_date("2016"), (date(2016, 1, 1), "year"))
+        self.assertEqual(normalize_pub_date("2016-02"), (date(2016, 2, 1), "month"))
+        self.assertEqual(normalize_pub_date("2016-02-03"), (date(2016, 2, 3), "day"))
+
+    def test_normalize_pub_date_not_a_date(self):
+        """ Tests to see if strings which are not dates give (None, None)"""
+        self.assertEqual(normalize_pub_date("error"), (None, None))
+        self.assertEqual(normalize_pub_date(None), (None, None))
+
+    def test_format_pub_date(self):
+        """ Tests to see if a date is formatted back with its precision"""
+        self.assertEqual(format_pub_date(date(2016, 2, 3), "year"), "2016")
+        self.assertEqual(format_pub_date(date(2016, 2, 3), "month"), "2016-02")
+        self.assertEqual(format_pub_date(date(2016, 2, 3), "day"), "2016-02-03")
+        self.assertIsNone(format_pub_date(None, None))
+
+    def test_run_concurrently_order(self):
+        """ Tests to see if results are returned in the same order as the arguments"""
+        self.assertEqual(run_concurrently(lambda n: n * 2, [3, 1, 2], 2), [6, 2, 4])
+
+    def test_run_concurrently_default(self):
+        """ Tests to see if calls that raise get the default value"""
+        self.assertEqual(run_concurrently(lambda n: 10 // n, [5, 0], 2, default="Unknown"), [2, "Unknown"])
+
+    def test_run_concurrently_timeout(self):
+        """ Tests to see if calls that do not finish before the deadline get the default value"""
+        event = Event()
+        results = run_concurrently(lambda n: n if n else event.wait(5), [1, 0], 2, timeout=0.1, default="late")
+        event.set()
+        self.assertEqual(results, [1, "late"])
+
+    def test_run_concurrently_error(self):
+        """ Tests to see if calls that raise and calls that time out can get different values"""
+        event = Event()
+        results = run_concurrently(lambda n: 10 // n if n else event.wait(5), [5, 0, "x"], 3, timeout=0.1,
+                                   default="late", error="failed")
+        event.set()
+        self.assertEqual(results, [2, "late", "failed"])
+
+
+class UpstreamUtilTests(TestCase):
+    """ Testing the shared upstream HTTP client"""
+    def tearDown(self):
+        """ Makes sure no sessions, breaker states or test rate limits are kept between tests"""
+        upstream_util.reset_sessions()
+        upstream_util.reset_breakers()
+        upstream_util.set_deadline(None)
+        upstream_util.register_limiter("https://b.com", None)
+
+    def test_get_host(self):
+        """ Tests to see if the scheme and host are taken from a url"""
+        self.assertEqual(upstream_util.get_host("https://www.goodreads.com/series/show/?id=1"),
+                         "https://www.goodreads.com")
+
+    def test_get_session_reused(self):
+        """ Tests to see if the same session is returned for the same host"""
+        session = upstream_util.get_session("https://www.goodreads.com")
+        self.assertIs(session, upstream_util.get_session("https://www.goodreads.com"))
+        self.assertIsNot(session, upstream_util.get_session("https://www.googleapis.com"))
+
+    def test_after_fork_drops_sessions(self):
+        """ Tests to see if sessions are not reused after a fork"""
+        session = upstream_util.get_session("https://www.goodreads.com")
+        upstream_util.after_fork()
+        self.assertIsNot(session, upstream_util.get_session("https://www.goodreads.com"))
+
+    def test_get_uses_timeouts(self):
+        """ Tests to see if requests are made through the host session with timeouts set"""
+        session = upstream_util.get_session("https://www.googleapis.com")
+        with patch.object(session, "get") as mock_get:
+            mock_get.return_value.status_code = 200
+            upstream_util.get("https://www.googleapis.com/books/v1/volumes", params={"q": "a"})
+        mock_get.assert_called_once_with("https://www.googleapis.com/books/v1/volumes", params={"q": "a"},
+                                         headers=None, timeout=(upstream_util.UPSTREAM_CONNECT_TIMEOUT,
+                                                                upstream_util.UPSTREAM_READ_TIMEOUT))
+
+    def test_breaker_opens_after_failures(self):
+        """ Tests to see if requests stop being made once the breaker opens"""
+        session = upstream_util.get_session("https://www.googleapis.com")
+        with patch.object(session, "get") as mock_get:
+            mock_get.return_value.status_code = 500
+            for i in range(upstream_util.UPSTREAM_BREAKER_FAILURES + 2):
+                response = upstream_util.get("https://www.googleapis.com/books/v1/volumes")
+        self.assertEqual(mock_get.call_count, upstream_util.UPSTREAM_BREAKER_FAILURES)
+        self.assertEqual(response.status_code, 503)
+
+    def test_breaker_trial_closes(self):
+        """ Tests to see if a successful trial call closes an open breaker"""
+        breaker = upstream_util.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record(False)
+        self.assertTrue(breaker.allow())
+        breaker.record(True, 0.1)
+        self.assertEqual(breaker.stats(), {"open": False, "failures": 0, "trips": 1})
+
+    def test_breaker_counts_slow_calls(self):
+        """ Tests to see if calls slower than the threshold count as failures"""
+        breaker = upstream_util.CircuitBreaker(failure_threshold=1, reset_timeout=60, slow_threshold=1)
+        breaker.record(True, 2)
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.allow())
+
+    def test_get_after_deadline(self):
+        """ Tests to see if no request is made once the deadline has passed"""
+        session = upstream_util.get_session("https://www.googleapis.com")
+        upstream_util.set_deadline(0)
+        with patch.object(session, "get") as mock_get:
+            self.assertEqual(upstream_util.get("https://www.googleapis.com/books/v1/volumes").status_code, 504)
+        mock_get.assert_not_called()
+
+    def test_get_timeout_fits_deadline(self):
+        """ Tests to see if the request timeout is cut short to fit the remaining time"""
+        session = upstream_util.get_session("https://www.googleapis.com")
+        upstream_util.set_deadline(2)
+        with patch.object(session, "get") as mock_get:
+            mock_get.return_value.status_code = 200
+            upstream_util.get("https://www.googleapis.com/books/v1/volumes")
+        self.assertLessEqual(max(mock_get.call_args[1]["timeout"]), 2)
+
+    def test_remaining_time(self):
+        """ Tests to see if the remaining time is capped by the limit given, and is the limit with no deadline"""
+        self.assertEqual(upstream_util.remaining_time(5), 5)
+        upstream_util.set_deadline(60)
+        self.assertEqual(upstream_util.remaining_time(5), 5)
+        self.assertLessEqual(upstream_util.remaining_time(), 60)
+
+    def test_hedger_delay_needs_samples(self):
+        """ Tests to see if no hedging happens until enough latencies are known"""
+        hedger = upstream_util.Hedger(percentile=50, budget=1, min_samples=3)
+        hedger.record(0.2)
+        self.assertIsNone(hedger.get_delay())
+        hedger.record(0.4)
+        hedger.record(0.6)
+        self.assertEqual(hedger.get_delay(), 0.4)
+
+    def test_hedger_budget(self):
+        """ Tests to see if duplicates are capped by the budget"""
+        hedger = upstream_util.Hedger(budget=0.5)
+        for i in range(4):
+            hedger.count_request()
+        self.assertEqual([hedger.take_hedge() for i in range(3)], [True, True, False])
+
+    def test_get_hedged_first_response_wins(self):
+        """ Tests to see if a slow request is duplicated and the faster response returned"""
+        hedger = upstream_util.get_hedger("https://www.googleapis.com")
+        hedger.budget = 1
+        for i in range(hedger.min_samples):
+            hedger.record(0.01)
+        calls = []
+
+        def fake_get(url, params=None, headers=None):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(1)
+                return MagicMock(status_code=200, content=b"slow")
+            return MagicMock(status_code=200, content=b"fast")
+
+        started = time.time()
+        with patch("upstream_util.get", side_effect=fake_get) as mock_get:
+            response = upstream_util.get_hedged("https://www.googleapis.com/books/v1/volumes/1")
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(response.content, b"fast")
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(hedger.stats()["wins"], 1)
+
+    def test_get_hedged_first_failed(self):
+        """ Tests to see if the duplicate's response is used when the first request fails"""
+        hedger = upstream_util.get_hedger("https://www.googleapis.com")
+        hedger.budget = 1
+        for i in range(hedger.min_samples):
+            hedger.record(0.01)
+        calls = []
+
+        def fake_get(url, params=None, headers=None):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return MagicMock(status_code=503)
+            time.sleep(1)
+            return MagicMock(status_code=200, content=b"duplicate")
+
+        with patch("upstream_util.get", side_effect=fake_get):
+            response = upstream_util.get_hedged("https://www.googleapis.com/books/v1/volumes/1")
+        self.assertEqual(response.content, b"duplicate")
+
+    def test_get_timeout_response(self):
+        """ Tests to see if a timed out request comes back as a 504 instead of raising"""
+        session = upstream_util.get_session("https://www.googleapis.com")
+        with patch.object(session, "get", side_effect=requests.Timeout()):
+            self.assertEqual(upstream_util.get("https://www.googleapis.com/books/v1/volumes").status_code, 504)
+
+    def test_call_with_breaker_unreachable(self):
+        """ Tests to see if a connection error is reported instead of raised"""
+        def fetch():
+            raise requests.ConnectionError()
+        self.assertEqual(upstream_util.call_with_breaker("https://en.wikipedia.org", fetch), (False, None))
+
+    def test_call_with_breaker_timeout(self):
+        """ Tests to see if a call which does not answer in time is given up on"""
+        event = Event()
+        self.assertEqual(upstream_util.call_with_breaker("https://en.wikipedia.org", lambda: event.wait(5), timeout=0.1),
+                         (False, None))
+        event.set()
+
+    def test_get_waits_for_rate_limit(self):
+        """ Tests to see if a request which cannot get a token in time is not made"""
+        limiter = RateLimiter(0.01)
+        upstream_util.register_limiter("https://b.com", limiter)
+        session = upstream_util.get_session("https://b.com")
+        with patch.object(session, "get") as mock_get, patch("ratelimit_util.RATE_LIMIT_MAX_WAIT", 0.05):
+            mock_get.return_value.status_code = 200
+            upstream_util.get("https://b.com/x", params={"key": "abcd"})
+            self.assertEqual(upstream_util.get("https://b.com/x", params={"key": "abcd"}).status_code, 429)
+        self.assertEqual(mock_get.call_count, 1)
+
+
+class RateLimitUtilTests(TestCase):
+    """ Testing the token buckets and priority scheduling of upstream calls"""
+    def test_burst_then_wait(self):
+        """ Tests to see if a burst is let through at once and later calls wait for tokens"""
+        scheduler = PriorityScheduler(rate=10, capacity=2)
+        started = time.time()
+        self.assertTrue(scheduler.acquire())
+        self.assertTrue(scheduler.acquire())
+        self.assertLess(time.time() - started, 0.05)
+        self.assertTrue(scheduler.acquire())
+        self.assertGreaterEqual(time.time() - started, 0.08)
+
+    def test_acquire_timeout(self):
+        """ Tests to see if a call gives up once its timeout passes, and is counted"""
+        scheduler = PriorityScheduler(rate=0.01, capacity=1)
+        scheduler.acquire()
+        self.assertFalse(scheduler.acquire(timeout=0.05))
+        self.assertEqual(scheduler.stats()["interactive"]["timeouts"], 1)
+        self.assertEqual(scheduler.stats()["interactive"]["queued"], 0)
+
+    def test_interactive_goes_first(self):
+        """ Tests to see if an interactive call gets the next token before a background call waiting longer"""
+        scheduler = PriorityScheduler(rate=10, capacity=1)
+        scheduler.acquire()
+        order = []
+        background = Thread(target=lambda: order.append(scheduler.acquire(BACKGROUND) and "background"))
+        interactive = Thread(target=lambda: order.append(scheduler.acquire(INTERACTIVE) and "interactive"))
+        background.start()
+        time.sleep(0.02)
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, ["interactive", "background"])
+
+    def test_priority_context(self):
+        """ Tests to see if the priority applies only inside the with block"""
+        with priority(BACKGROUND):
+            self.assertEqual(get_priority(), BACKGROUND)
+        self.assertEqual(get_priority(), INTERACTIVE)
+
+    def test_limiter_keys(self):
+        """ Tests to see if each API key gets its own bucket"""
+        limiter = RateLimiter(0.01)
+        self.assertTrue(limiter.acquire({"key": "key-one"}, timeout=0.05))
+        self.assertTrue(limiter.acquire({"key": "key-two"}, timeout=0.05))
+        self.assertFalse(limiter.acquire({"key": "key-one"}, timeout=0.05))
+        self.assertEqual(sorted(limiter.stats()), ["...-one", "...-two"])
+
+
+class KeyPoolUtilTests(TestCase):
+    """ Testing the API key pools"""
+    def tearDown(self):
+        """ Makes sure the test key pool and sessions are not kept between tests"""
+        upstream_util.register_key_pool("https://c.com", None)
+        upstream_util.reset_sessions()
+
+    def test_round_robin(self):
+        """ Tests to see if keys are taken in turn"""
+        pool = KeyPool("Test", ["a", "b"], selection="round_robin")
+        self.assertEqual([pool.choose() for i in range(3)], ["a", "b", "a"])
+
+    def test_cooldown(self):
+        """ Tests to see if a refused key is skipped until it has cooled down"""
+        pool = KeyPool("Test", ["a", "b"], cooldown=60)
+        pool.report("a", 429)
+        self.assertEqual([pool.choose() for i in range(2)], ["b", "b"])
+        pool.report("b", 403)
+        self.assertIsNone(pool.choose())
+        self.assertEqual(sorted(pool.stats()["cooling_down"]), ["...a", "...b"])
+
+    def test_cooldown_only_for_quota_403(self):
+        """ Tests to see if a 403 that is not about the quota does not cool the key down"""
+        pool = KeyPool("Test", ["a"], cooldown=60)
+        pool.report("a", 403, "accessNotConfigured")
+        self.assertEqual(pool.choose(), "a")
+        pool.report("a", 403, "dailyLimitExceeded")
+        self.assertIsNone(pool.choose())
+
+    def test_least_used(self):
+        """ Tests to see if the key with the fewest requests this hour is picked"""
+        pool = KeyPool("Test", ["a", "b"], selection="least_used")
+        pool.report("a", 200)
+        self.assertEqual(pool.choose(), "b")
+
+    def test_usage_report(self):
+        """ Tests to see if requests and refusals are counted per key for the hour"""
+        pool = KeyPool("Test", ["abcdef"])
+        pool.report("abcdef", 200)
+        pool.report("abcdef", 429)
+        self.assertEqual(list(pool.usage_report().values()), [{"...cdef": {"requests": 2, "refused": 1}}])
+
+    def test_get_keys(self):
+        """ Tests to see if the key list is read, falling back to the single key"""
+        with patch.dict(os.environ, {"TEST_KEYS": "a, b", "TEST_KEY": "c"}):
+            self.assertEqual(get_keys("TEST_KEYS", "TEST_KEY"), ["a", "b"])
+            self.assertEqual(get_keys("NO_TEST_KEYS", "TEST_KEY"), ["c"])
+
+    def test_get_uses_key_pool(self):
+        """ Tests to see if the key param is replaced by a key from the host's pool"""
+        upstream_util.register_key_pool("https://c.com", KeyPool("C", ["key-one", "key-two"]))
+        session = upstream_util.get_session("https://c.com")
+        with patch.object(session, "get") as mock_get:
+            mock_get.return_value.status_code = 200
+            upstream_util.get("https://c.com/x", params={"key": "original", "id": "1"})
+            upstream_util.get("https://c.com/x", params={"key": "original", "id": "1"})
+        self.assertEqual([call[1]["params"] for call in mock_get.call_args_list],
+                         [{"key": "key-one", "id": "1"}, {"key": "key-two", "id": "1"}])
+
+
+class CacheUtilTests(TestCase):
+    """ Testing the in-process LRU cache"""
+    def test_cache_hit_and_miss(self):
+        """ Tests to see if stored values are returned and counted as hits"""
+        cache = LRUCache(10000)
+        cache.set("1", {"length": "3"})
+        self.assertEqual(cache.get("1"), {"length": "3"})
+        self.assertIsNone(cache.get("2"))
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 1))
+
+    def test_cache_evicts_least_recently_used(self):
+        """ Tests to see if the least recently used value is evicted when over the byte budget"""
+        cache = LRUCache(250)
+        cache.set("a", "a" * 100)
+        cache.set("b", "b" * 100)
+        cache.get("a")
+        cache.set("c", "c" * 100)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a" * 100)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_cache_value_too_large(self):
+        """ Tests to see if values bigger than the whole budget are not stored"""
+        cache = LRUCache(50)
+        cache.set("a", "a" * 100)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def check_backend(self, cache):
+        """ Checks the behaviour every cache backend has to share"""
+        cache.set("a", {"title": "A"})
+        cache.set("gone", 1, ttl=0.01)
+        self.assertEqual(cache.get("a"), {"title": "A"})
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": {"title": "A"}})
+        self.assertFalse(cache.add("a", "other"))
+        self.assertTrue(cache.add("b", "new", ttl=60))
+        self.assertEqual(cache.get("b"), "new")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("gone"))
+        self.assertTrue(cache.add("gone", 2))
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertEqual(cache.get_many(["b", "gone"]), {})
+
+    def test_memory_backend(self):
+        """ Tests to see if the in-process backend supports ttls, add and bulk get"""
+        self.check_backend(LRUCache(10000))
+
+    def test_sqlite_backend(self):
+        """ Tests to see if the SQLite backend supports ttls, add and bulk get, shared between instances"""
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.sqlite3")
+            self.check_backend(SQLiteCache(path, "series"))
+            SQLiteCache(path, "series").set("shared", 1)
+            self.assertEqual(SQLiteCache(path, "series").get("shared"), 1)
+            self.assertIsNone(SQLiteCache(path, "authors").get("shared"))
+
+    def test_sqlite_purge_expired(self):
+        """ Tests to see if expired rows are deleted from the SQLite backend"""
+        with TemporaryDirectory() as tmp:
+            cache = SQLiteCache(os.path.join(tmp, "cache.sqlite3"), "series")
+            cache.set("gone", 1, ttl=0.01)
+            cache.set("kept", 2)
+            time.sleep(0.02)
+            self.assertEqual(cache.purge_expired(), 1)
+            self.assertEqual(cache.get("kept"), 2)
+
+    def test_redis_backend(self):
+        """ Tests to see if the Redis backend supports ttls, add and bulk get, using the local stand-in"""
+        client = LocalRedis()
+        client.set("unrelated", b"1")
+        self.check_backend(RedisCache(client, "series"))
+        self.assertEqual(client.get("unrelated"), b"1")
+
+    def test_backend_shared(self):
+        """ Tests to see if only backends seen by every worker are marked shared"""
+        with TemporaryDirectory() as tmp:
+            self.assertTrue(SQLiteCache(os.path.join(tmp, "cache.sqlite3"), "series").shared)
+        self.assertFalse(LRUCache(10000).shared)
+        self.assertFalse(RedisCache(LocalRedis(), "series").shared)
+
+
+class UpstreamRevalidationTests(TestCase):
+    """ Testing conditional GET revalidation of cached upstream responses"""
+    def setUp(self):
+        """ Makes a fresh cache for each test"""
+        self.cache = LRUCache(10000)
+
+    def test_get_parsed_fresh(self):
+        """ Tests to see if a fresh entry is returned without a request"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.headers = {"ETag": '"v1"'}
+            upstream_util.get_parsed("https://a.com/x", {}, lambda r: "parsed", self.cache, "x", 60)
+            self.assertEqual(upstream_util.get_parsed("https://a.com/x", {}, lambda r: "other", self.cache, "x", 60), "parsed")
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_get_parsed_not_modified(self):
+        """ Tests to see if a stale entry is revalidated with its validators and kept on a 304"""
+        self.cache.set("x", {"value": "parsed", "etag": '"v1"', "last_modified": "Mon, 30 Jul 2018 00:00:00 GMT",
+                             "fresh_until": 0})
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 304
+            result = upstream_util.get_parsed("https://a.com/x", {}, lambda r: self.fail("should not parse"), self.cache, "x", 60)
+        self.assertEqual(result, "parsed")
+        self.assertEqual(mock_request.call_args[1]["headers"], {"If-None-Match": '"v1"',
+                                                                 "If-Modified-Since": "Mon, 30 Jul 2018 00:00:00 GMT"})
+        self.assertGreater(self.cache.get("x")["fresh_until"], time.time())
+
+    def test_get_parsed_modified(self):
+        """ Tests to see if a stale entry is replaced when the upstream sends a new response"""
+        self.cache.set("x", {"value": "old", "etag": '"v1"', "last_modified": None, "fresh_until": 0})
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.headers = {"ETag": '"v2"'}
+            self.assertEqual(upstream_util.get_parsed("https://a.com/x", {}, lambda r: "new", self.cache, "x", 60), "new")
+        self.assertEqual(self.cache.get("x")["etag"], '"v2"')
+
+    def test_get_parsed_ttl_function(self):
+        """ Tests to see if a ttl function is given the parsed value to pick the freshness"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.headers = {}
+            upstream_util.get_parsed("https://a.com/x", {}, lambda r: 0, self.cache, "x", lambda value: value)
+        self.assertLessEqual(self.cache.get("x")["fresh_until"], time.time())
+
+    def test_get_parsed_stale_on_error(self):
+        """ Tests to see if a stale value is served, and marked, when the request fails"""
+        self.cache.set("x", {"value": "old", "etag": None, "last_modified": None, "fresh_until": 0})
+        upstream_util.track_stale()
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 503
+            self.assertEqual(upstream_util.get_parsed("https://a.com/x", {}, lambda r: "new", self.cache, "x", 60), "old")
+        self.assertTrue(upstream_util.served_stale())
+
+    def test_get_parsed_stale_while_revalidate(self):
+        """ Tests to see if a recently stale value is served while it is refreshed in the background"""
+        self.cache.set("x", {"value": "old", "etag": None, "last_modified": None, "fresh_until": time.time() - 1})
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.headers = {}
+            self.assertEqual(upstream_util.get_parsed("https://a.com/x", {}, lambda r: "new", self.cache, "x", 60), "old")
+            deadline = time.time() + 5
+            while self.cache.get("x")["value"] != "new" and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(self.cache.get("x")["value"], "new")
+
+    def test_get_parsed_error(self):
+        """ Tests to see if None is returned and nothing cached when the request fails"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 500
+            self.assertIsNone(upstream_util.get_parsed("https://a.com/x", {}, lambda r: "parsed", self.cache, "x", 60))
+        self.assertIsNone(self.cache.get("x"))
+
+
+class UpstreamCoalescingTests(TestCase):
+    """ Testing that identical concurrent upstream lookups share one request"""
+    def setUp(self):
+        """ Makes a fresh cache for each test"""
+        self.cache = LRUCache(10000)
+
+    def get_concurrently(self, callers, status_code=200):
+        """ Calls get_parsed from several threads while the first request is held open.
+        Returns the results and the mocked get."""
+        release = Event()
+        results = []
+
+        def slow_get(*args, **kwargs):
+            release.wait(5)
+            return MagicMock(status_code=status_code, headers={})
+
+        with patch("upstream_util.get", side_effect=slow_get) as mock_request:
+            threads = [Thread(target=lambda: results.append(upstream_util.get_parsed(
+                "https://a.com/x", {"id": 1}, lambda r: "parsed", self.cache, "x", 60))) for i in range(callers)]
+
+            for thread in threads:
+                thread.start()
+
+            deadline = time.time() + 5
+            while mock_request.call_count < 1 and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.1)  # lets the other callers reach the flight
+            release.set()
+
+            for thread in threads:
+                thread.join()
+
+        return results, mock_request
+
+    def test_get_parsed_coalesced(self):
+        """ Tests to see if concurrent callers for the same url share one request"""
+        results, mock_request = self.get_concurrently(3)
+        self.assertEqual(results, ["parsed"] * 3)
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_get_parsed_too_many_waiters(self):
+        """ Tests to see if callers over the waiter cap make their own request"""
+        with patch("upstream_util.UPSTREAM_COALESCE_MAX_WAITERS", 0):
+            results, mock_request = self.get_concurrently(3)
+        self.assertEqual(results, ["parsed"] * 3)
+        self.assertEqual(mock_request.call_count, 3)
+
+    def test_get_parsed_leader_failed(self):
+        """ Tests to see if callers waiting on a request that failed make their own"""
+        results, mock_request = self.get_concurrently(3, status_code=500)
+        self.assertEqual(results, [None] * 3)
+        self.assertEqual(mock_request.call_count, 3)
+
+    def test_flight_key_ignores_param_order(self):
+        """ Tests to see if the same params in a different order are coalesced"""
+        self.assertEqual(upstream_util.get_flight_key("https://a.com/x", {"a": 1, "b": 2}),
+                         upstream_util.get_flight_key("https://a.com/x", {"b": 2, "a": 1}))
+
 
 class GoogleUtilTests(TestCase):
     """Testing Google Books Utility Functions"""
+    def setUp(self):
+        """ Makes sure no dates are cached between tests"""
+        title_date_cache.clear()
+        volume_date_cache.clear()
+
     def test_pub_date_with_book_id(self):
         """Tests to see if function returns date when given a dictionary from API"""
-        with patch('requests.get') as mock_request:
+        with patch('upstream_util.get') as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.json.return_value = {"volumeInfo": {"publishedDate": "2016-07-07"}}
             self.assertEqual("2016-07-07", get_pub_date_with_book_id("1"))
 
     def test_pub_date_with_book_id_error(self):
         """ Tests to see if function returns string error when API error occurs"""
-        with patch('requests.get') as mock_request:
+        with patch('upstream_util.get') as mock_request:
             mock_request.return_value.status_code = 400
             self.assertEqual("error", get_pub_date_with_book_id("1"))
 
+    def test_pub_dates_with_book_ids_order(self):
+        """ Tests to see if dates looked up concurrently come back in the order of the ids given"""
+        dates = {"1": "2016-07-07", "2": "error", "3": "2018"}
+        with patch("google_util.get_pub_date_with_book_id") as mock_date:
+            mock_date.side_effect = lambda google_id: dates[google_id]
+            self.assertEqual(["2016-07-07", "error", "2018"], get_pub_dates_with_book_ids(["1", "2", "3"]))
+
+    def test_pub_dates_with_book_ids_serial(self):
+        """ Tests to see if dates are still looked up when only one worker is allowed"""
+        with patch("google_util.get_pub_date_with_book_id") as mock_date:
+            mock_date.return_value = "2016"
+            self.assertEqual(["2016", "2016"], get_pub_dates_with_book_ids(["1", "2"], max_workers=1))
+
     def test_pub_date_with_title(self):
         """ Tests to see if function returns date when given a title"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.json.return_value = {"items": [{"id": "1"}]}
             with patch("google_util.get_pub_date_with_book_id") as mock_result:
                 mock_result.return_value = "2016-08-03"
                 self.assertEqual("2016-08-03", get_pub_date_with_title("Title"))
 
+    def test_pub_date_with_title_one_request(self):
+        """ Tests to see if the date in the search result is used without looking up the volume"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.json.return_value = {"items": [{"id": "1", "volumeInfo": {"publishedDate": "2017-01"}}]}
+            with patch("google_util.get_pub_date_with_book_id") as mock_result:
+                self.assertEqual("2017-01", get_pub_date_with_title("Title"))
+                mock_result.assert_not_called()
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(mock_request.call_args[1]["params"]["maxResults"], 1)
+
+    def test_pub_date_with_title_no_items(self):
+        """ Tests to see if function returns string error when nothing matches the title"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.json.return_value = {}
+            self.assertEqual("error", get_pub_date_with_title("Title"))
+
+    def test_pub_date_with_book_id_cached(self):
+        """ Tests to see if a date is only requested once for the same book"""
+        with patch('upstream_util.get') as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.json.return_value = {"volumeInfo": {"publishedDate": "2016-07-07"}}
+            get_pub_date_with_book_id("1")
+            self.assertEqual("2016-07-07", get_pub_date_with_book_id("1"))
+        self.assertEqual(mock_request.call_count, 1)
+
     def test_pub_date_with_title_error(self):
         """Tests to see if function returns string error when API error occurs"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 400
             self.assertEqual("error", get_pub_date_with_title("Title"))
 
 
 class GoodreadsUtilTests(TestCase):
     """ Tests for Goodreads Utility Functions"""
+    def setUp(self):
+        """ Makes sure no parsed results are cached between tests"""
+        series_cache.clear()
+        author_series_cache.clear()
+        author_cache.clear()
+        unknown_author_cache.clear()
+
     def test_sort_series_zero_series(self):
         """ Tests to see if sort_series functions returns an empty dictionary if passed in an empty list"""
         self.assertEqual(sort_series([]), {})
@@ -211,55 +822,144 @@ class GoodreadsUtilTests(TestCase):
 
     def test_author_goodreads_info_error(self):
         """ Checks to see if function returns (None, None) when status code is not 200"""
-        with patch('requests.get') as mock_request:
+        with patch('upstream_util.get') as mock_request:
             mock_request.return_value.status_code = 400
             self.assertEqual((None, None), get_author_goodreads_info("Doesn't Exist"))
 
     def test_author_goodreads_info_no_info(self):
         """Tests to see if function returns (None, None) if no author information is provided"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<Goodreads></Goodreads>"
             self.assertEqual((None, None), get_author_goodreads_info("John Doe"))
 
     def test_author_goodreads_info_exists(self):
         """ Checks to see if function returns proper info when status code is 200"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<Goodreads><author id='40'><name>John Doe</name></author></Goodreads>"
             self.assertEqual(("40", "John Doe"), get_author_goodreads_info("John Doe"))
 
+    def test_author_goodreads_info_error_not_cached(self):
+        """ Checks to see if a failed request is tried again on the next lookup"""
+        with patch('upstream_util.get') as mock_request:
+            mock_request.return_value.status_code = 503
+            get_author_goodreads_info("John Doe")
+            get_author_goodreads_info("John Doe")
+        self.assertEqual(mock_request.call_count, 2)
+
+    def test_author_goodreads_info_unknown_cached(self):
+        """ Checks to see if a name Goodreads does not know is not looked up again"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 404
+            get_author_goodreads_info("Nobody Atall")
+            self.assertEqual((None, None), get_author_goodreads_info("nobody  atall"))
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_author_goodreads_info_corrected_name_cached(self):
+        """ Checks to see if both the typed name and the corrected name are cached"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.content = "<Goodreads><author id='40'><name>John Doe</name></author></Goodreads>"
+            get_author_goodreads_info("Jon Doe")
+            self.assertEqual(("40", "John Doe"), get_author_goodreads_info("john doe"))
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_normalize_author_name(self):
+        """ Checks to see if case, spacing and initials do not change the key"""
+        self.assertEqual(normalize_author_name(" J.K.  Rowling"), normalize_author_name("j. k. rowling"))
+
     def test_get_series_list_by_author_error(self):
         """ Tests to see if function returns None when an error occured"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 400
             self.assertIsNone(get_series_list_by_author(1))
 
     def test_get_series_list_by_author_no_series(self):
         """Tests to see if function returns an empty dictionary if no series are present"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<series> </series>"
             self.assertEqual({}, get_series_list_by_author(1))
 
     def test_get_series_list_by_author_with_series(self):
         """ Tests to see if get_series_list_by_author returns series when they are present"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<response><series_works><book></book></series_works></response>"
             with patch("goodreads_util.sort_series") as mock_sort:
                 mock_sort.return_value = {"1": "a series"}
                 self.assertEqual(get_series_list_by_author("1"), {"1": "a series"})
 
+    def test_get_series_list_by_author_cached(self):
+        """ Tests to see if a series list is only requested once for the same author"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.content = "<series> </series>"
+            get_series_list_by_author(1)
+            self.assertEqual({}, get_series_list_by_author(1))
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_get_series_info_cached(self):
+        """ Tests to see if parsed series info is returned and only requested once"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.content = """<response><series>
+            <description><![CDATA[ A <b>great</b> series ]]></description>
+            <primary_work_count>1</primary_work_count>
+            <series_works><series_work>
+            <user_position> 1 </user_position>
+            <work> <id>99</id> <best_book> <title>Test</title>
+            <author> <id>5</id> <name>Bob Bob</name></author>
+            <image_url> url </image_url></best_book>
+            <original_publication_year>2016</original_publication_year>
+            <original_publication_month/>
+            <original_publication_day/>
+            </work></series_work></series_works></series></response>"""
+            get_series_info("3")
+            series_info = get_series_info("3")
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(series_info["description"], "A great series")
+        self.assertEqual(series_info["length"], "1")
+        self.assertEqual(series_info["works"], [{"title": "Test", "published": "2016", "author": "Bob Bob", "cover": "url",
+                                                 "position": "1", "work_id": "99", "author_id": "5"}])
+
+    def test_get_series_info_error(self):
+        """ Tests to see if errors return None and are not cached"""
+        with patch("upstream_util.get") as mock_request:
+            mock_request.return_value.status_code = 400
+            self.assertIsNone(get_series_info("3"))
+        self.assertIsNone(series_cache.get("3"))
+
+    def test_series_ttl_upcoming_release(self):
+        """ Tests to see if a series with a book coming out soon is refreshed often"""
+        now = datetime(2018, 7, 30, 23, 30)
+        today = {"works": [{"title": "Out", "published": "2016"}, {"title": "Next", "published": "2018-07-31"}]}
+        soon = {"works": [{"title": "Out", "published": "2016"}, {"title": "Next", "published": "2018-08-01"}]}
+        later = {"works": [{"title": "Out", "published": "2016"}, {"title": "Next", "published": "2018-12-01"}]}
+        self.assertEqual(get_series_ttl(today, now), SERIES_TTL_MIN)
+        self.assertEqual(get_series_ttl(soon, now), (24 + 0.5) * 60 * 60 / 4)
+        self.assertLess(get_series_ttl(soon, now), get_series_ttl(later, now))
+
+    def test_series_ttl_finished_series(self):
+        """ Tests to see if a series with no new books in years is refreshed rarely"""
+        finished = {"works": [{"title": "Last", "published": "2011-05-01"}]}
+        self.assertEqual(get_series_ttl(finished, datetime(2018, 7, 30)), SERIES_TTL_MAX)
+
+    def test_series_ttl_untitled_book(self):
+        """ Tests to see if a series waiting on an untitled book uses the placeholder ttl"""
+        waiting = {"works": [{"title": "Out", "published": "2011"}, {"title": "Untitled Book 3", "published": None}]}
+        self.assertEqual(get_series_ttl(waiting, datetime(2018, 7, 30)), SERIES_CACHE_TTL)
+
     def test_get_last_books_of_series_error(self):
         """ Tests to see if function returns error if issue occurs during API call"""
-        with patch('requests.get') as mock_request:
+        with patch('upstream_util.get') as mock_request:
             mock_request.return_value.status_code = 400
             self.assertEqual({'status': 'error'}, get_last_book_of_series("a", "b", 1, 1))
 
     def test_get_last_book_of_series_default(self):
         """ Tests to see if function returns expected value when searching in default timeframe"""
-        with patch('requests.get') as mock_request:
+        with patch('upstream_util.get') as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = """<response><series>
             <primary_work_count>2</primary_work_count>
@@ -272,13 +972,13 @@ class GoodreadsUtilTests(TestCase):
             <original_publication_month>3</original_publication_month>
             <original_publication_day>9</original_publication_day>
             </work></series_work></series_works></series></response>"""
-            exp_result = ('Test 2', '2016-03-09', 'url')
+            exp_result = ('Title: <i>Test 2</i>', 'Publication date: 2016-03-09', 'url')
             exp_dict = {'status': 'ok', 'results': exp_result}
-            self.assertEqual(exp_dict, get_last_book_of_series('series', '1', 'date', 0))
+            self.assertEqual(exp_dict, get_last_book_of_series('series', '1', datetime(2018, 1, 1), timedelta(days=0)))
 
     def test_get_last_book_of_series_not_in_range(self):
         """Tests to see if function returns expected value when there are no books in search range"""
-        with patch('requests.get') as mock_request:
+        with patch('upstream_util.get') as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = """<response><series>
             <primary_work_count>2</primary_work_count>
@@ -295,6 +995,92 @@ class GoodreadsUtilTests(TestCase):
             self.assertEqual({'status': 'ok', "results": exp_r}, get_last_book_of_series('series', 1, datetime.now(), timedelta(days=183)))
 
 
+class ReleaseUtilTests(TestCase):
+    """ Tests for the series release index"""
+    def make_works(self, *published):
+        """ Makes one work per publication date given, at positions 1, 2, 3..."""
+        return [{"title": "Book {}".format(i + 1), "published": p, "cover": "url", "position": str(i + 1)}
+                for i, p in enumerate(published)]
+
+    def test_parse_position(self):
+        """ Tests to see if positions are parsed as numbers, and omnibus positions are not"""
+        self.assertEqual(parse_position(" 2 "), 2.0)
+        self.assertEqual(parse_position("0.5"), 0.5)
+        self.assertIsNone(parse_position("1-3"))
+        self.assertIsNone(parse_position(None))
+
+    def test_index_skips_non_primary_works(self):
+        """ Tests to see if novellas, omnibuses and works past the series length are left out"""
+        works = self.make_works("2010", "2012", "2014")
+        works.append({"title": "Novella", "published": "2011", "cover": "url", "position": "1.5"})
+        works.append({"title": "Omnibus", "published": "2015", "cover": "url", "position": "1-3"})
+        index = SeriesReleaseIndex(works, length="2")
+        self.assertEqual([work["title"] for work in index.works], ["Book 1", "Book 2"])
+
+    def test_latest_on_or_before(self):
+        """ Tests to see if the most recent work on or before a date is found"""
+        index = SeriesReleaseIndex(self.make_works("2010", "2012-05", "2014-01-02"))
+        self.assertEqual(index.latest_on_or_before(datetime(2013, 1, 1))[1], "2012-05")
+        self.assertEqual(index.latest_on_or_before(datetime(2014, 1, 2))[1], "2014-01-02")
+        self.assertIsNone(index.latest_on_or_before(datetime(2009, 1, 1)))
+
+    def test_first_between(self):
+        """ Tests to see if the first work inside a window is found"""
+        index = SeriesReleaseIndex(self.make_works("2010", "2012-05", "2014-01-02"))
+        self.assertEqual(index.first_between(datetime(2011, 1, 1), datetime(2015, 1, 1))[1], "2012-05")
+        self.assertIsNone(index.first_between(datetime(2012, 6, 1), datetime(2013, 1, 1)))
+        self.assertIsNone(index.first_between(datetime(2015, 1, 1), datetime(2016, 1, 1)))
+
+    def test_index_orders_by_date(self):
+        """ Tests to see if works are ordered by date when every date is known"""
+        index = SeriesReleaseIndex(self.make_works("2014", "2010"))
+        self.assertEqual(index.published, ["2010", "2014"])
+
+    def test_lazy_resolution(self):
+        """ Tests to see if only the dates needed by a query are resolved"""
+        looked_up = []
+
+        def resolve(title):
+            looked_up.append(title)
+            return "20{}".format(10 + int(title.split()[1]))
+
+        index = SeriesReleaseIndex(self.make_works(*([None] * 16)), resolve_date=resolve, max_lookups=16)
+        self.assertEqual(index.latest_on_or_before(datetime(2020, 6, 1))[0]["title"], "Book 10")
+        self.assertLessEqual(len(looked_up), 5)
+
+    def test_cached_dates_not_counted(self):
+        """ Tests to see if dates already cached do not use up the lookups"""
+        cached = {"Book {}".format(i + 1): "20{}".format(10 + i) for i in range(8)}
+        index = SeriesReleaseIndex(self.make_works(*([None] * 8)), resolve_date=lambda title: self.fail("should not look up"),
+                                   max_lookups=2, cached_date=cached.get)
+        self.assertEqual(index.latest_on_or_before(datetime(2030, 1, 1))[1], "2017")
+        self.assertEqual(index.lookups, 0)
+        self.assertFalse(index.degraded)
+
+    def test_untitled_works_not_resolved(self):
+        """ Tests to see if untitled placeholder works are treated as unpublished without a lookup"""
+        works = self.make_works("2010", None)
+        works[1]["title"] = "Untitled"
+        index = SeriesReleaseIndex(works, resolve_date=lambda title: self.fail("should not look up"))
+        self.assertEqual(index.latest_on_or_before(datetime(2020, 1, 1))[1], "2010")
+        self.assertIsNone(index.first_between(datetime(2019, 1, 1), datetime(2021, 1, 1)))
+        self.assertFalse(index.degraded)
+
+    def test_failed_lookup_latest_on_or_before(self):
+        """ Tests to see if a failed date lookup does not hide the works after it"""
+        index = SeriesReleaseIndex(self.make_works("2011", "2012", None, "2014", "2015"),
+                                   resolve_date=lambda title: "error")
+        self.assertEqual(index.latest_on_or_before(datetime(2030, 1, 1))[1], "2015")
+        self.assertTrue(index.degraded)
+
+    def test_failed_lookup_first_between(self):
+        """ Tests to see if a failed date lookup for the first book does not hide the rest"""
+        index = SeriesReleaseIndex(self.make_works(None, "2012", "2013", "2014", "2015"),
+                                   resolve_date=lambda title: "error")
+        self.assertEqual(index.first_between(datetime(2010, 1, 1), datetime(2013, 6, 1))[1], "2012")
+        self.assertTrue(index.degraded)
+
+
 class FlaskNotLoggedInTests(TestCase):
     """ Integration tests for when user is not logged in"""
     def setUp(self):
@@ -308,6 +1094,15 @@ class FlaskNotLoggedInTests(TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn(b"Welcome to Bibliofind", result.data)
 
+    def test_upstream_stats_caches(self):
+        """ Tests to see if the counters of every cache are reported"""
+        search_cache.get("missing")
+        result = self.client.get("/upstream-stats.json")
+        caches = result.get_json()["caches"]
+        self.assertIn("wikipedia", caches)
+        self.assertGreaterEqual(caches["search_results"]["misses"], 1)
+        self.assertIn("evictions", caches["search_results"])
+
     def test_login_page(self):
         """ Tests to see if login page renders properly"""
         result = self.client.get("/login")
@@ -335,7 +1130,7 @@ class FlaskNotLoggedInTests(TestCase):
 
     def test_book_search_error(self):
         """ Tests to see if, if API does not send a proper request, searching by book goes back to advanced search page"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 400
             result = self.client.post("/by-book", data={"title": "Failure"}, follow_redirects=True)
         self.assertEqual(result.status_code, 200)
@@ -344,7 +1139,7 @@ class FlaskNotLoggedInTests(TestCase):
 
     def test_book_search_no_books(self):
         """Tests to see if by-book renders properly if no books are provided from search"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<response> <search><results></results></search></response>"
             result = self.client.post("/by-book", data={"title": "Gibberish"})
@@ -354,7 +1149,7 @@ class FlaskNotLoggedInTests(TestCase):
 
     def test_book_search_shows_results(self):
         """ Tests to see if by-book shows the series returned in API response """
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = """
             <Response> <search> <results>
@@ -382,7 +1177,7 @@ class FlaskNotLoggedInTests(TestCase):
 
     def test_book_series_error(self):
         """Tests to see if book-series redirects properly if error occurs in API call"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 400
             result = self.client.post("/book-series", data={"book": "1|| Failure"}, follow_redirects=True)
         self.assertEqual(result.status_code, 200)
@@ -391,7 +1186,7 @@ class FlaskNotLoggedInTests(TestCase):
 
     def test_book_series_no_series(self):
         """ Tests to see if book-series shows all series related to book if API call is successful"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<response> </response>"
             result = self.client.post("/book-series", data={"book": "1|| Seriesless"})
@@ -401,7 +1196,7 @@ class FlaskNotLoggedInTests(TestCase):
 
     def test_book_series_series(self):
         """ Tests to see if book-series show all series related to book if API call is successful and series are there"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 200
             mock_request.return_value.content = "<response><series_works><series_work></series_work></series_works></response>"
             with patch("server.sort_series") as mock_series:
@@ -411,6 +1206,15 @@ class FlaskNotLoggedInTests(TestCase):
         self.assertIn(b"Series That Yay Series", result.data)
         self.assertIn(b"A series", result.data)
 
+    def test_search_timeout(self):
+        """ Tests to see if a search which ran out of time says so"""
+        with patch("server.request_deadline", 0):
+            with patch.object(upstream_util.get_session("https://www.googleapis.com"), "get") as mock_get:
+                result = self.client.post("/search.json", data={"author": "Jane Doe", "timeframe": "0",
+                                                                 "date": "Mon Jul 30 2018"})
+        mock_get.assert_not_called()
+        self.assertEqual(json.loads(result.data), {"status": "error", "reason": "timeout"})
+
 
 class FlaskNotLoggedInDatabaseTests(TestCase):
     """ Integration tests for when user is not logged in and have database interactions"""
@@ -420,6 +1224,10 @@ class FlaskNotLoggedInDatabaseTests(TestCase):
         self.client = app.test_client()
         app.config["TESTING"] = True
 
+        wikipedia_cache.clear()
+        search_cache.clear()
+        author_cache.clear()
+        unknown_author_cache.clear()
         connect_to_db(app, "postgresql:///testdb")
 
         db.create_all()
@@ -555,7 +1363,7 @@ class FlaskNotLoggedInDatabaseTests(TestCase):
 
     def test_series_info_API_failure(self):
         """Tests to see if series info page renders properly if there is an API failure"""
-        with patch("requests.get") as mock_request:
+        with patch("upstream_util.get") as mock_request:
             mock_request.return_value.status_code = 400
             result = self.client.get("/series/1")
         self.assertEqual(result.status_code, 200)
@@ -563,6 +1371,192 @@ class FlaskNotLoggedInDatabaseTests(TestCase):
         self.assertIn(b"Bob&#39;s Adventure", result.data)
         self.assertIn(b"Could not get info", result.data)
 
+    def test_search_batch(self):
+        """Tests to see if a batch search dedupes targets and returns a result for each"""
+        with patch("server.get_series_search_results") as mock_series:
+            mock_series.return_value = {"status": "ok", "results": ("Title: <i>Bob</i>", "Publication date: 2016", "url")}
+            with patch("server.get_author_search_results") as mock_author:
+                mock_author.return_value = {"status": "error"}
+                result = self.client.post("/search-batch.json", data={"series": ["1", "1"], "author": ["Bob Bob", "bob  bob"],
+                                                                      "timeframe": "0", "date": "Mon Jul 30 2018"})
+        self.assertEqual(result.status_code, 200)
+        results = result.get_json()["results"]
+        self.assertEqual([(r["type"], r["name"], r["status"]) for r in results],
+                         [("series", "Bob's Adventure", "ok"), ("author", "Bob Bob", "error")])
+        self.assertEqual(mock_series.call_count, 1)
+
+    def test_search_batch_stream(self):
+        """Tests to see if batch results are streamed as events followed by a summary"""
+        with patch("server.get_series_search_results") as mock_series:
+            mock_series.return_value = {"status": "ok", "results": ("Title: <i>Bob</i>", "Publication date: 2016", "url")}
+            result = self.client.get("/search-batch.stream?series=1&timeframe=0&date=Mon+Jul+30+2018")
+            data = result.get_data(as_text=True)
+        self.assertEqual(result.mimetype, "text/event-stream")
+        self.assertEqual(data.count("event: result"), 1)
+        self.assertIn("Bob's Adventure", data)
+        self.assertIn('"ok": 1', data.split("event: summary")[1])
+
+    def test_search_batch_nothing_to_search(self):
+        """Tests to see if an error is returned when there is nothing to search"""
+        result = self.client.post("/search-batch.json", data={"timeframe": "0", "date": "Mon Jul 30 2018"})
+        self.assertEqual(result.get_json(), {"status": "error"})
+
+    def test_series_info_page_stored(self):
+        """Tests to see if series works are stored and the page is then built from the database"""
+        series_info = {"description": "Bob goes places", "length": "1",
+                       "works": [{"title": "Bob Begins", "published": "2015-06", "author": "Bob Bob", "cover": "bob.jpg",
+                                  "position": "1", "work_id": "77", "author_id": "8388"}]}
+        with patch("series_util.get_series_info") as mock_info:
+            mock_info.return_value = series_info
+            self.client.get("/series/1")
+            result = self.client.get("/series/1")
+        self.assertEqual(mock_info.call_count, 1)
+        self.assertIn(b"Bob Begins by Bob Bob, published 2015-06", result.data)
+        self.assertIsNotNone(Series.query.get(1).works_updated_at)
+
+    def test_series_info_served_stale_not_stored(self):
+        """Tests to see if series info Goodreads could only give from its stale cache is not stored as fresh"""
+        series_info = {"description": "", "length": "0", "works": []}
+
+        def get_stale_info(goodreads_id):
+            upstream_util.mark_stale()
+            return series_info
+
+        with patch("series_util.get_series_info", side_effect=get_stale_info):
+            self.assertEqual(get_stored_series_info(Series.query.get(1)), series_info)
+        self.assertIsNone(Series.query.get(1).works_updated_at)
+
+    def test_save_series_info_one_row_per_book(self):
+        """Tests to see if a work listed twice is stored once, and works no longer listed are removed"""
+        work = {"title": "Bob Begins", "published": "2015", "author": "Bob Bob", "cover": "bob.jpg",
+                "position": "1", "work_id": "77", "author_id": "8388"}
+        series = Series.query.get(1)
+        save_series_info(series, {"description": "", "length": "2", "works": [work, dict(work, position="1.5")]})
+        self.assertEqual([(sw.book.goodreads_work_id, sw.position) for sw in series.works], [("77", "1")])
+        save_series_info(series, {"description": "", "length": "1", "works": [dict(work, work_id="78")]})
+        self.assertEqual([sw.book.goodreads_work_id for sw in series.works], ["78"])
+        self.assertEqual(Book.query.filter_by(goodreads_work_id="77").count(), 1)
+
+    def test_series_search_precomputed(self):
+        """Tests to see if a series search is answered from the precomputed result for the day"""
+        save_precomputed_result(Series.query.get(1), date(2018, 7, 30), 0,
+                                ("Title: <i>Bob</i>", "Publication date: 2016", "url"))
+        with patch("server.compute_series_search_results") as mock_compute:
+            result = self.client.post("/search.json", data={"series": "1", "timeframe": "0", "date": "Mon Jul 30 2018"})
+        mock_compute.assert_not_called()
+        self.assertEqual(result.get_json(), {"status": "ok", "results": ["Title: <i>Bob</i>", "Publication date: 2016", "url"]})
+
+    def test_precompute_all(self):
+        """Tests to see if results are stored for every series and timeframe, and outdated once the works change"""
+        with patch("precompute.compute_series_search_results") as mock_compute:
+            mock_compute.return_value = {"status": "ok", "results": (None, None, "404.png")}
+            self.assertEqual(precompute_all(date(2018, 7, 30)), len(timeframes))
+        series = Series.query.get(1)
+        self.assertEqual(get_precomputed_result(series, date(2018, 7, 30), 365), (None, None, "404.png"))
+        self.assertIsNone(get_precomputed_result(series, date(2018, 7, 31), 365))
+        series.works_updated_at = datetime.now() + timedelta(seconds=1)
+        self.assertIsNone(get_precomputed_result(series, date(2018, 7, 30), 365))
+
+    def test_precompute_skips_degraded(self):
+        """Tests to see if results worked out without a date they needed are not stored"""
+        with patch("precompute.compute_series_search_results") as mock_compute:
+            mock_compute.return_value = {"status": "ok", "results": (None, None, "404.png"), "degraded": True}
+            self.assertEqual(precompute_all(date(2018, 7, 30)), 0)
+        self.assertIsNone(get_precomputed_result(Series.query.get(1), date(2018, 7, 30), 365))
+
+    def test_series_search_memoized(self):
+        """Tests to see if a series search result is reused until the series info changes"""
+        series_info = {"description": "", "length": "1",
+                       "works": [{"title": "Bob Begins", "published": "2015", "author": "Bob Bob", "cover": "bob.jpg",
+                                  "position": "1", "work_id": "77", "author_id": "8388"}]}
+        data = {"series": "1", "timeframe": "0", "date": "Mon Jul 30 2018"}
+        with patch("server.get_stored_series_info") as mock_info:
+            mock_info.return_value = series_info
+            with patch("server.get_last_book_of_series") as mock_last:
+                mock_last.return_value = {"status": "ok", "results": ("Title: <i>Bob Begins</i>", "Publication date: 2015", "bob.jpg")}
+                self.client.post("/search.json", data=data)
+                self.client.post("/search.json", data=data)
+                self.assertEqual(mock_last.call_count, 1)
+                series_info["works"][0]["published"] = "2015-06"
+                self.client.post("/search.json", data=data)
+                self.assertEqual(mock_last.call_count, 2)
+
+    def test_degraded_series_search_not_memoized(self):
+        """Tests to see if a series search worked out without a date it needed is not reused"""
+        series_info = {"description": "", "length": "1",
+                       "works": [{"title": "Bob Begins", "published": None, "author": "Bob Bob", "cover": "bob.jpg",
+                                  "position": "1", "work_id": "77", "author_id": "8388"}]}
+        data = {"series": "1", "timeframe": "0", "date": "Mon Jul 30 2018"}
+        with patch("server.get_stored_series_info") as mock_info:
+            mock_info.return_value = series_info
+            with patch("server.get_last_book_of_series") as mock_last:
+                mock_last.return_value = {"status": "ok", "results": (None, None, "404.png"), "degraded": True}
+                self.client.post("/search.json", data=data)
+                self.client.post("/search.json", data=data)
+                self.assertEqual(mock_last.call_count, 2)
+
+    def test_warmup_order_and_progress(self):
+        """Tests to see if the most favorited series and authors are warmed first and progress is reported"""
+        db.session.add(Fav_Author(user_id=1, author_id=2))
+        db.session.commit()
+        warmed = []
+        run_warmup(app, lambda kind, row: warmed.append((kind, row.series_name if kind == "series" else row.author_name))
+                   or kind == "series")
+        self.assertEqual(warmed, [("author", "The Cool Dude"), ("series", "Bob's Adventure"), ("author", "Bob Bob")])
+        result = self.client.get("/warmup-status.json")
+        self.assertEqual([result.get_json()[key] for key in ("state", "total", "done", "failed")], ["done", 3, 3, 2])
+
+    def test_warm_cache_searches_author_once(self):
+        """Tests to see if an author's books are searched for once for every timeframe"""
+        with patch("server.search_author_books") as mock_search:
+            mock_search.return_value = {"items": []}
+            with patch("server.compute_author_search_results") as mock_compute:
+                mock_compute.return_value = {"status": "ok", "results": (None, None, "404.png")}
+                self.assertTrue(warm_cache("author", Author(author_name="Nobody")))
+        self.assertEqual(mock_search.call_count, 1)
+        self.assertEqual(mock_compute.call_count, len(timeframes))
+        self.assertEqual(mock_compute.call_args[0][3], {"items": []})
+
+    def test_author_search_failed_date_degraded(self):
+        """Tests to see if an author search that skipped a book it could not date is marked degraded and not reused"""
+        books = {"items": [{"id": "1", "volumeInfo": {"title": "Upcoming"}}, {"id": "2", "volumeInfo": {"title": "Lost"}},
+                           {"id": "3", "volumeInfo": {"title": "Old"}}]}
+        with patch("server.get_pub_date_with_book_id", return_value="2030-01-01"):
+            with patch("server.get_pub_dates_with_book_ids", return_value=["error", "2010"]) as mock_dates:
+                results = get_author_search_results("Bob Bob", datetime(2018, 7, 30), timedelta(0), books)
+                get_author_search_results("Bob Bob", datetime(2018, 7, 30), timedelta(0), books)
+        self.assertTrue(results["degraded"])
+        self.assertEqual(results["results"][0], "Title: <i>Old</i>")
+        self.assertEqual(mock_dates.call_count, 2)
+
+    def test_warmup_locked(self):
+        """Tests to see if a worker skips the warm-up when another holds the lock"""
+        lock_cache = LRUCache(10000)
+        lock_cache.add("warmup-lock", 1)
+        with patch("warmup_util.rank_by_favorites") as mock_rank:
+            run_warmup(app, lambda kind, row: True, lock_cache)
+        mock_rank.assert_not_called()
+        self.assertEqual(get_progress()["state"], "skipped")
+
+    def test_releases_between_dates(self):
+        """Tests to see if stored books in the date range are returned in date order"""
+        series = Series.query.get(1)
+        for title, pub_date in [("Late", date(2019, 5, 1)), ("Early", date(2019, 2, 1)), ("Too Late", date(2021, 1, 1))]:
+            db.session.add(Series_Work(series=series, position="1",
+                                       book=Book(title=title, pub_date=pub_date, pub_date_precision="day")))
+        db.session.commit()
+
+        result = self.client.get("/releases.json?start=2019-01-01&end=2019-12-31")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([r["title"] for r in result.get_json()["results"]], ["Early", "Late"])
+        self.assertEqual(result.get_json()["results"][0]["published"], "2019-02-01")
+        self.assertFalse(result.get_json()["has_next"])
+
+    def test_releases_bad_dates(self):
+        """Tests to see if an error is returned when dates cannot be read"""
+        result = self.client.get("/releases.json?start=soon&end=later")
+        self.assertEqual(result.get_json(), {"status": "error"})
+
     def test_author_search_no_goodreads(self):
         """ Tests to see if user is redirected properly if searching by an author not in goodreads"""
         with patch("server.get_author_goodreads_info") as mock_response:
@@ -587,6 +1581,10 @@ class FlaskLoggedInTests(TestCase):
                 sess["search_history"] = []
                 # can add things to search history if needed
 
+        wikipedia_cache.clear()
+        search_cache.clear()
+        author_cache.clear()
+        unknown_author_cache.clear()
         connect_to_db(app, "postgresql:///testdb")
         db.create_all()
         example_data()
@@ -665,6 +1663,24 @@ class FlaskLoggedInTests(TestCase):
         self.assertIn(b"Bob.jpg", result.data)
         self.assertIn(b"No series", result.data)
 
+    def test_goodreads_oauth_request_token(self):
+        """Tests to see if a request token is only requested when the user starts the OAuth flow"""
+        with patch("server.get_goodreads_service") as mock_service:
+            mock_service.return_value.get_request_token.return_value = ("token", "secret")
+            mock_service.return_value.get_authorize_url.return_value = "https://www.goodreads.com/oauth/authorize?oauth_token=token"
+            with self.client as c:
+                result = c.get("/goodreads-oauth")
+                self.assertEqual(session["gr_request_token"], "token")
+                self.assertEqual(session["gr_request_token_secret"], "secret")
+        self.assertEqual(result.status_code, 302)
+        self.assertIn("oauth_token=token", result.location)
+
+    def test_goodreads_oauth_callback_without_token(self):
+        """Tests to see if the OAuth callback is refused when no request token was handed out"""
+        result = self.client.get("/gr-oauth-authorized?authorize=1", follow_redirects=True)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b"Authorization denied", result.data)
+
     def test_user_series_page_dne(self):
         """Tests to see if logged-in user gets redirected properly when attempting to access a page that does not exist"""
         result = self.client.get("/series/1890", follow_redirects=True)
@@ -0,0 +1,734 @@
+""" Shared HTTP client for all upstream API calls (Goodreads, Google Books) """
+import os
+import time
+import threading
+import contextvars
+import requests
+
+from collections import deque
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from requests.adapters import HTTPAdapter
+
+import keypool_util
+import ratelimit_util
+
+# pool sizes are per host: one session (and so one pool) is kept for each upstream
+UPSTREAM_POOL_CONNECTIONS = int(os.environ.get("UPSTREAM_POOL_CONNECTIONS", 4))
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get("UPSTREAM_POOL_MAXSIZE", 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10))
+# how long a cached response is kept after it stops being fresh, so it can be revalidated
+UPSTREAM_REVALIDATE_WINDOW = int(os.environ.get("UPSTREAM_REVALIDATE_WINDOW", 7 * 24 * 60 * 60))
+# concurrent get_parsed calls for the same url and params share one request; past this many
+# waiters, or after waiting this long, callers make their own
+UPSTREAM_COALESCE_MAX_WAITERS = int(os.environ.get("UPSTREAM_COALESCE_MAX_WAITERS", 50))
+UPSTREAM_COALESCE_TIMEOUT = float(os.environ.get("UPSTREAM_COALESCE_TIMEOUT",
+                                                 UPSTREAM_CONNECT_TIMEOUT + UPSTREAM_READ_TIMEOUT))
+
+# a host's circuit breaker opens after this many failures (errors, or calls slower than
+# UPSTREAM_BREAKER_SLOW seconds) in a row, and lets a trial call through every UPSTREAM_BREAKER_RESET seconds
+UPSTREAM_BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5))
+UPSTREAM_BREAKER_RESET = float(os.environ.get("UPSTREAM_BREAKER_RESET", 30))
+UPSTREAM_BREAKER_SLOW = float(os.environ.get("UPSTREAM_BREAKER_SLOW", 5))
+# for this long after a cached value stops being fresh, it is served as is while a background
+# thread refreshes it; older values are refreshed before answering
+UPSTREAM_STALE_WHILE_REVALIDATE = int(os.environ.get("UPSTREAM_STALE_WHILE_REVALIDATE", 60 * 60))
+UPSTREAM_REFRESH_WORKERS = int(os.environ.get("UPSTREAM_REFRESH_WORKERS", 2))
+# hedged requests (see get_hedged) send a duplicate once a request has taken longer than
+# this percentile of the host's recent latencies, as long as duplicates stay under
+# UPSTREAM_HEDGE_BUDGET of all hedged requests
+UPSTREAM_HEDGE_PERCENTILE = float(os.environ.get("UPSTREAM_HEDGE_PERCENTILE", 95))
+UPSTREAM_HEDGE_BUDGET = float(os.environ.get("UPSTREAM_HEDGE_BUDGET", 0.05))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.environ.get("UPSTREAM_HEDGE_MIN_SAMPLES", 20))
+UPSTREAM_HEDGE_MIN_DELAY = float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", 0.05))
+UPSTREAM_HEDGE_WORKERS = int(os.environ.get("UPSTREAM_HEDGE_WORKERS", 8))
+# threads for calls through client libraries that have no timeout of their own (see call_with_timeout)
+UPSTREAM_CALL_WORKERS = int(os.environ.get("UPSTREAM_CALL_WORKERS", 4))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_breakers = {}  # host: CircuitBreaker
+_hedgers = {}  # host: Hedger
+_limiters = {}  # host: RateLimiter every request to the host waits on
+_key_pools = {}  # host: KeyPool the key param of requests to the host is picked from
+_hedge_executor = None
+_call_executor = None
+_flights = {}  # flight key: Flight in progress
+_flights_lock = threading.Lock()
+_refreshing = set()  # flight keys being refreshed in the background
+_refresh_executor = None
+# whether a stale value was served while answering the current request (see track_stale)
+_stale = contextvars.ContextVar("upstream_stale", default=None)
+# when the current request must be done with its upstream calls (see set_deadline)
+_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+
+
+def get_host(url):
+    """ Given a url, returns the scheme and host part of it, which is used to key
+    the connection pools. """
+    parts = urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc)
+
+
+def get_session(host):
+    """ Returns the keep-alive session used for the host given, creating it if
+    this is the first request made to that host."""
+    session = _sessions.get(host)
+
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=UPSTREAM_POOL_CONNECTIONS,
+                                      pool_maxsize=UPSTREAM_POOL_MAXSIZE)
+                session.mount(host, adapter)
+                _sessions[host] = session
+
+    return session
+
+
+def reset_sessions():
+    """ Closes and forgets all pooled sessions."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+
+        _sessions.clear()
+
+
+def reset_breakers():
+    """ Forgets the state of all circuit breakers and hedgers."""
+    with _sessions_lock:
+        _breakers.clear()
+        _hedgers.clear()
+
+
+def after_fork():
+    """ Drops the pooled sessions, circuit breakers, in-flight requests and background
+    threads in a freshly forked process, since connections and threads must not be
+    shared between processes. The locks are replaced first, since another thread of the
+    parent may have been holding them."""
+    global _sessions_lock, _flights_lock, _refresh_executor, _hedge_executor, _call_executor
+
+    _sessions_lock = threading.Lock()
+    _flights_lock = threading.Lock()
+    _flights.clear()
+    _refreshing.clear()
+    _refresh_executor = None
+    _hedge_executor = None
+    _call_executor = None
+    reset_sessions()
+    reset_breakers()
+
+    for limiter in _limiters.values():
+        limiter.after_fork()
+
+    for pool in _key_pools.values():
+        pool.after_fork()
+
+
+class CircuitBreaker(object):
+    """ Stops calls to an upstream once failure_threshold calls in a row have failed
+    (errored, or taken longer than slow_threshold seconds), so an outage costs one
+    quick error instead of a slow timeout per request. Once the breaker has been open
+    for reset_timeout seconds, one trial call is let through: a success closes it,
+    a failure keeps it open for another reset_timeout."""
+
+    def __init__(self, failure_threshold=None, reset_timeout=None, slow_threshold=None):
+        self.failure_threshold = failure_threshold or UPSTREAM_BREAKER_FAILURES
+        self.reset_timeout = reset_timeout if reset_timeout is not None else UPSTREAM_BREAKER_RESET
+        self.slow_threshold = slow_threshold or UPSTREAM_BREAKER_SLOW
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """ Returns True if calls are being refused and no trial call is due."""
+        opened_at = self.opened_at
+        return opened_at is not None and time.time() - opened_at < self.reset_timeout
+
+    def allow(self):
+        """ Returns True if a call may be made. While open, only lets through one
+        trial call per reset_timeout."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if time.time() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.time()  # the next trial waits for another reset_timeout
+                return True
+
+            return False
+
+    def record(self, ok, seconds=0):
+        """ Records the outcome of a call that was allowed, and how long it took."""
+        with self._lock:
+            if ok and seconds <= self.slow_threshold:
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+
+                self.opened_at = time.time()
+
+    def stats(self):
+        """ Returns a dictionary of the breaker state and counters."""
+        return {"open": self.opened_at is not None, "failures": self.failures, "trips": self.trips}
+
+
+def register_limiter(host, limiter):
+    """ Makes every request to host wait for a token from limiter (a
+    ratelimit_util.RateLimiter) first. A limiter of None removes the host's."""
+    if limiter is None:
+        _limiters.pop(host, None)
+
+    else:
+        _limiters[host] = limiter
+
+
+def register_key_pool(host, pool):
+    """ Makes requests to host which have a key param use a key picked from pool (a
+    keypool_util.KeyPool) instead, so call sites can keep passing a single key. A
+    pool of None removes the host's."""
+    if pool is None:
+        _key_pools.pop(host, None)
+
+    else:
+        _key_pools[host] = pool
+
+
+def get_stats():
+    """ Returns the state of the circuit breakers, hedgers, rate limiters and key
+    pools, by host."""
+    return {"breakers": {host: breaker.stats() for host, breaker in list(_breakers.items())},
+            "hedgers": {host: hedger.stats() for host, hedger in list(_hedgers.items())},
+            "rate_limits": {host: limiter.stats() for host, limiter in list(_limiters.items())},
+            "key_pools": {host: pool.stats() for host, pool in list(_key_pools.items())}}
+
+
+def get_breaker(host):
+    """ Returns the circuit breaker for the host given, creating it if needed."""
+    breaker = _breakers.get(host)
+
+    if breaker is None:
+        with _sessions_lock:
+            breaker = _breakers.setdefault(host, CircuitBreaker())
+
+    return breaker
+
+
+class Hedger(object):
+    """ Keeps the recent latencies of a host and decides when a duplicate of a slow
+    request is worth sending: after the percentile-th latency, and only while the
+    duplicates sent stay within budget (a fraction) of the requests made."""
+
+    def __init__(self, percentile=None, budget=None, min_samples=None, window=200):
+        self.percentile = percentile or UPSTREAM_HEDGE_PERCENTILE
+        self.budget = budget if budget is not None else UPSTREAM_HEDGE_BUDGET
+        self.min_samples = min_samples or UPSTREAM_HEDGE_MIN_SAMPLES
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """ Records the latency of a successful request."""
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def get_delay(self):
+        """ Returns how long to wait before hedging, or None while there are too few
+        latencies to tell what slow is."""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+
+            latencies = sorted(self.latencies)
+
+        index = int(round(self.percentile / 100 * (len(latencies) - 1)))
+        return max(UPSTREAM_HEDGE_MIN_DELAY, latencies[index])
+
+    def count_request(self):
+        """ Counts a hedged request towards the budget."""
+        with self._lock:
+            self.requests += 1
+
+    def take_hedge(self):
+        """ Returns True, and counts it, if another duplicate fits in the budget."""
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+
+            self.hedges += 1
+            return True
+
+    def count_win(self):
+        """ Counts a duplicate whose response was used: it answered before the
+        original, or the original failed."""
+        with self._lock:
+            self.wins += 1
+
+    def stats(self):
+        """ Returns a dictionary of the hedging counters."""
+        return {"requests": self.requests, "hedges": self.hedges, "wins": self.wins, "delay": self.get_delay()}
+
+
+def get_hedger(host):
+    """ Returns the hedger for the host given, creating it if needed."""
+    hedger = _hedgers.get(host)
+
+    if hedger is None:
+        with _sessions_lock:
+            hedger = _hedgers.setdefault(host, Hedger())
+
+    return hedger
+
+
+def get_hedged(url, params=None, headers=None):
+    """ Makes a GET request like get, but if it has not answered once the host's
+    hedger says it is slow, sends the same request again and returns whichever
+    response comes back first. If that one failed, the other is waited for."""
+    global _hedge_executor
+
+    hedger = get_hedger(get_host(url))
+    hedger.count_request()
+    delay = hedger.get_delay()
+
+    def timed_get():
+        started = time.time()
+        response = get(url, params=params, headers=headers)
+
+        if response.status_code in (200, 304):
+            hedger.record(time.time() - started)
+
+        return response
+
+    if delay is None:
+        return timed_get()
+
+    if _hedge_executor is None:
+        with _sessions_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=UPSTREAM_HEDGE_WORKERS)
+
+    first = _hedge_executor.submit(contextvars.copy_context().run, timed_get)
+    done, pending = wait([first], timeout=delay)
+
+    if done or not hedger.take_hedge():
+        return first.result()
+
+    second = _hedge_executor.submit(contextvars.copy_context().run, timed_get)
+    done, pending = wait([first, second], return_when=FIRST_COMPLETED)
+    winner, other = (first, second) if first in done else (second, first)
+    response = winner.result()
+
+    if response.status_code not in (200, 304):  # the other may still answer
+        response, winner = other.result(), other
+
+        if response.status_code not in (200, 304):
+            response, winner = first.result(), first
+
+    if winner is second:
+        hedger.count_win()
+
+    return response
+
+
+def make_error_response(url, status_code):
+    """ Returns an empty Response with the status code given, standing in for a request
+    that could not be made, so callers handle it like any other failed request."""
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = url
+    response._content = b""
+    return response
+
+
+def set_deadline(seconds):
+    """ Gives the current context (a request, and the worker threads it starts) seconds
+    to make all of its upstream calls; None removes the deadline. Called at the start
+    of each route that calls upstreams."""
+    _deadline.set(time.time() + seconds if seconds is not None else None)
+
+
+def remaining_time(limit=None):
+    """ Returns the seconds left before the current deadline, capped at limit. Returns
+    limit if there is no deadline."""
+    deadline = _deadline.get()
+
+    if deadline is None:
+        return limit
+
+    remaining = max(0, deadline - time.time())
+    return remaining if limit is None else min(limit, remaining)
+
+
+def deadline_exceeded():
+    """ Returns True if the current deadline has passed."""
+    return remaining_time() == 0
+
+
+def get(url, params=None, headers=None, timeout=None, hedge=False):
+    """ Makes a GET request through the pooled session for the url's host.
+    Returns the requests Response object, same as requests.get would. If the host's
+    circuit breaker is open or the connection fails the response is a 503, and if
+    the request times out it is a 504; neither raises. Timeouts are cut short to fit
+    the current deadline, and once it has passed the response is a 504 right away.
+    If the host has a key pool, the key param is replaced by a key from the pool. If
+    the host has a rate limiter, the request first waits its turn for a token of its
+    key, and is a 429 if it cannot get one in time (or every key is cooling down).
+    With hedge, slow requests are duplicated (see get_hedged)."""
+    if hedge:
+        return get_hedged(url, params=params, headers=headers)
+
+    host = get_host(url)
+    breaker = get_breaker(host)
+
+    if remaining_time() == 0:
+        return make_error_response(url, 504)
+
+    if breaker.is_open():
+        return make_error_response(url, 503)
+
+    pool = _key_pools.get(host)
+    api_key = None
+
+    if pool is not None and params and "key" in params:
+        api_key = pool.choose()
+
+        if api_key is None:  # every key is cooling down
+            return make_error_response(url, 429)
+
+        params = dict(params, key=api_key)
+
+    limiter = _limiters.get(host)
+
+    if limiter is not None and not limiter.acquire(params, remaining_time(ratelimit_util.RATE_LIMIT_MAX_WAIT)):
+        return make_error_response(url, 429)
+
+    remaining = remaining_time()  # waiting for a token may have used some of it
+    cut_short = False
+
+    if timeout is None:
+        timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+
+        if remaining is not None and remaining < UPSTREAM_READ_TIMEOUT:
+            timeout = (min(UPSTREAM_CONNECT_TIMEOUT, remaining), remaining)
+            cut_short = True
+
+    if remaining == 0:
+        return make_error_response(url, 504)
+
+    if not breaker.allow():
+        return make_error_response(url, 503)
+
+    started = time.time()
+
+    try:
+        response = get_session(host).get(url, params=params, headers=headers, timeout=timeout)
+
+    except requests.Timeout:
+        if not cut_short:  # running out of our own budget is not the upstream's fault
+            breaker.record(False)
+
+        response = make_error_response(url, 504)
+
+    except requests.ConnectionError:
+        breaker.record(False)
+        response = make_error_response(url, 503)
+
+    else:
+        breaker.record(response.status_code < 500 and response.status_code != 429, time.time() - started)
+
+    if api_key is not None:
+        reason = keypool_util.get_error_reason(response) if response.status_code == 403 else None
+        pool.report(api_key, response.status_code, reason)
+
+    return response
+
+
+def get_timeout():
+    """ Returns the (connect, read) timeout for a request made through a client library
+    instead of get, cut short to fit the current deadline."""
+    read = max(0.01, remaining_time(UPSTREAM_READ_TIMEOUT))
+    return (min(UPSTREAM_CONNECT_TIMEOUT, read), read)
+
+
+def call_with_timeout(func, timeout):
+    """ Returns func(), run in a worker thread, or raises requests.Timeout if it has
+    not finished after timeout seconds. The thread is left to finish on its own."""
+    global _call_executor
+
+    if _call_executor is None:
+        with _sessions_lock:
+            if _call_executor is None:
+                _call_executor = ThreadPoolExecutor(max_workers=UPSTREAM_CALL_WORKERS)
+
+    future = _call_executor.submit(contextvars.copy_context().run, func)
+
+    try:
+        return future.result(timeout=timeout)
+
+    except FuturesTimeoutError:
+        raise requests.Timeout("no answer after {:.2f} seconds".format(timeout))
+
+
+def call_with_breaker(host, func, timeout=None):
+    """ Calls func() with the circuit breaker of host, for upstreams reached through
+    a client library instead of get. If timeout is given, func is given up on after
+    that many seconds (see call_with_timeout). Returns (True, result), or (False, None)
+    if the breaker is open or func failed to reach the upstream. Other exceptions are
+    raised, as they are answers from the upstream rather than outages."""
+    breaker = get_breaker(host)
+
+    if deadline_exceeded() or not breaker.allow():
+        return (False, None)
+
+    started = time.time()
+
+    try:
+        result = func() if timeout is None else call_with_timeout(func, timeout)
+
+    except (requests.Timeout, requests.ConnectionError):
+        breaker.record(False)
+        return (False, None)
+
+    breaker.record(True, time.time() - started)
+    return (True, result)
+
+
+def track_stale():
+    """ Starts recording whether a stale cached value is served in the current context
+    (a request, or a worker thread's copy of it). Called at the start of each request."""
+    _stale.set({"stale": False})
+
+
+def mark_stale():
+    """ Records that a stale value was served in the current context."""
+    record = _stale.get()
+
+    if record is not None:
+        record["stale"] = True
+
+
+def served_stale():
+    """ Returns True if a stale value was served since track_stale was called."""
+    record = _stale.get()
+    return record is not None and record["stale"]
+
+
+def call_tracking_stale(func, *args):
+    """ Returns (func(*args), True if it served a stale value). A stale value is still
+    recorded in the current context as well."""
+    token = _stale.set({"stale": False})
+
+    try:
+        value = func(*args)
+        stale = served_stale()
+
+    finally:
+        _stale.reset(token)
+
+    if stale:
+        mark_stale()
+
+    return value, stale
+
+
+def get_parsed(url, params, parse, cache, key, ttl, hedge=False):
+    """ Returns parse(response) for a GET of url, cached under key for ttl seconds.
+    ttl can also be a function of the parsed value returning seconds, so values
+    that change often can be kept fresh for less time. Once an entry is no longer
+    fresh it is revalidated with the ETag/Last-Modified validators it was stored
+    with; a 304 keeps the cached value for another ttl without downloading or parsing
+    anything. Returns None if the request failed; if parse returns None, nothing is
+    cached.
+
+    A value which went stale less than UPSTREAM_STALE_WHILE_REVALIDATE seconds ago is
+    returned right away while a background thread revalidates it. Stale values are
+    also returned while the host's circuit breaker is open, or if the request fails;
+    either way mark_stale is called. hedge is passed on to get."""
+    entry = cache.get(key)
+    now = time.time()
+    flight_key = get_flight_key(url, params)
+
+    def fetch():
+        return fetch_parsed(url, params, parse, cache, key, ttl, entry, hedge)
+
+    if entry is not None:
+        if entry["fresh_until"] > now:
+            return entry["value"]
+
+        if get_breaker(get_host(url)).is_open():
+            mark_stale()
+            return entry["value"]
+
+        if now - entry["fresh_until"] < UPSTREAM_STALE_WHILE_REVALIDATE:
+            refresh_in_background(flight_key, fetch)
+            mark_stale()
+            return entry["value"]
+
+    failed, value = coalesce(flight_key, fetch, failed=lambda result: result[0])
+
+    if failed and entry is not None:  # stale beats nothing
+        mark_stale()
+        return entry["value"]
+
+    return value
+
+
+def fetch_parsed(url, params, parse, cache, key, ttl, entry, hedge=False):
+    """ Makes the request for get_parsed, revalidating entry if there is one, and
+    caches the parsed result. Returns (failed, value)."""
+    now = time.time()
+    response = get(url, params=params, headers=get_conditional_headers(entry), hedge=hedge)
+
+    if response.status_code == 304 and entry is not None:
+        store_entry(cache, key, entry, ttl, now)
+        return (False, entry["value"])
+
+    if response.status_code == 200:
+        value = parse(response)
+
+        if value is not None:
+            entry = {"value": value,
+                     "etag": get_header(response, "ETag"),
+                     "last_modified": get_header(response, "Last-Modified")}
+            store_entry(cache, key, entry, ttl, now)
+
+        return (False, value)
+
+    return (True, None)
+
+
+def refresh_in_background(flight_key, fetch):
+    """ Runs fetch in a background thread, unless a refresh for flight_key is already
+    queued or running."""
+    global _refresh_executor
+
+    with _flights_lock:
+        if flight_key in _refreshing:
+            return
+
+        _refreshing.add(flight_key)
+
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(max_workers=UPSTREAM_REFRESH_WORKERS)
+
+        executor = _refresh_executor
+
+    def refresh():
+        try:
+            with ratelimit_util.priority(ratelimit_util.BACKGROUND):
+                coalesce(flight_key, fetch, failed=lambda result: result[0])
+
+        finally:
+            with _flights_lock:
+                _refreshing.discard(flight_key)
+
+    executor.submit(refresh)
+
+
+class Flight(object):
+    """ A request in progress, which concurrent callers for the same key wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+        self.waiters = 0
+
+
+def get_flight_key(url, params):
+    """ Returns the key identical requests are coalesced under."""
+    return "{}?{}".format(url, urlencode(sorted((params or {}).items())))
+
+
+def coalesce(key, fetch, failed=None):
+    """ Returns fetch(), calling it only once for concurrent callers with the same key:
+    the first caller fetches and the others wait for its result. A caller makes its own
+    request if there are already UPSTREAM_COALESCE_MAX_WAITERS waiting, if the first
+    caller failed (raised, or failed(result) is True), or if it waited
+    UPSTREAM_COALESCE_TIMEOUT seconds (or until its deadline)."""
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+
+        if leader:
+            flight = Flight()
+            _flights[key] = flight
+
+        elif flight.waiters < UPSTREAM_COALESCE_MAX_WAITERS:
+            flight.waiters += 1
+
+        else:
+            flight = None
+
+    if flight is None:
+        return fetch()
+
+    if not leader:
+        if flight.done.wait(remaining_time(UPSTREAM_COALESCE_TIMEOUT)) and not flight.failed:
+            return flight.value
+
+        return fetch()
+
+    try:
+        flight.value = fetch()
+        flight.failed = failed is not None and failed(flight.value)
+
+    except Exception:
+        flight.failed = True
+        raise
+
+    finally:
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+        flight.done.set()
+
+    return flight.value
+
+
+def store_entry(cache, key, entry, ttl, now):
+    """ Marks a cache entry fresh for ttl (seconds, or a function of the value) from
+    now and stores it, keeping it for revalidation afterwards."""
+    if callable(ttl):
+        ttl = ttl(entry["value"])
+
+    entry["fresh_until"] = now + ttl
+    cache.set(key, entry, ttl + UPSTREAM_REVALIDATE_WINDOW)
+
+
+def get_conditional_headers(entry):
+    """ Returns the If-None-Match/If-Modified-Since headers for revalidating a cached
+    entry, or None if there is nothing to revalidate with."""
+    if entry is None:
+        return None
+
+    headers = {}
+
+    if entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+
+    if entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    return headers or None
+
+
+def get_header(response, name):
+    """ Returns a response header as a string, or None if it was not sent."""
+    value = response.headers.get(name)
+    return value if isinstance(value, str) else None
@@ -0,0 +1,101 @@
+""" Background warm-up of the caches after a deploy, most favorited series and authors first """
+import os
+import time
+import threading
+
+import ratelimit_util
+from model import db, Series, Fav_Series, Author, Fav_Author
+
+# set CACHE_WARMUP=1 to warm the caches when a worker starts
+CACHE_WARMUP = os.environ.get("CACHE_WARMUP") == "1"
+# seconds to wait before starting, so the app is serving requests first
+CACHE_WARMUP_DELAY = float(os.environ.get("CACHE_WARMUP_DELAY", 5))
+# most series, and most authors, warmed
+CACHE_WARMUP_LIMIT = int(os.environ.get("CACHE_WARMUP_LIMIT", 100))
+# with a shared cache backend only one worker warms up; others skip it for this long
+CACHE_WARMUP_LOCK_TTL = int(os.environ.get("CACHE_WARMUP_LOCK_TTL", 60 * 60))
+
+# progress of this process's warm-up, as shown by /warmup-status.json
+progress = {"state": "off", "total": 0, "done": 0, "failed": 0, "current": None,
+            "started_at": None, "finished_at": None}
+_progress_lock = threading.Lock()
+
+
+def update_progress(**values):
+    """ Updates the warm-up progress."""
+    with _progress_lock:
+        progress.update(values)
+
+
+def get_progress():
+    """ Returns a copy of the warm-up progress."""
+    with _progress_lock:
+        return dict(progress)
+
+
+def rank_by_favorites(limit=CACHE_WARMUP_LIMIT):
+    """ Returns the series and authors to warm, as (kind, row) pairs with kind series
+    or author, ordered by how many users favorited them (series first on ties)."""
+    fav_series_count = db.func.count(Fav_Series.fav_series_id)
+    series = (db.session.query(Series, fav_series_count)
+              .outerjoin(Fav_Series, Fav_Series.series_id == Series.series_id)
+              .group_by(Series.series_id)
+              .order_by(fav_series_count.desc(), Series.series_id)
+              .limit(limit).all())
+
+    fav_author_count = db.func.count(Fav_Author.fav_author_id)
+    authors = (db.session.query(Author, fav_author_count)
+               .outerjoin(Fav_Author, Fav_Author.author_id == Author.author_id)
+               .group_by(Author.author_id)
+               .order_by(fav_author_count.desc(), Author.author_id)
+               .limit(limit).all())
+
+    ranked = [(count, "series", row) for row, count in series] + [(count, "author", row) for row, count in authors]
+    ranked.sort(key=lambda ranked_row: -ranked_row[0])  # stable, so ties keep series first
+    return [(kind, row) for count, kind, row in ranked]
+
+
+def run_warmup(app, warm, lock_cache=None):
+    """ Calls warm(kind, row) for each series and author from rank_by_favorites, at
+    background priority so requests being served go first. warm returns True if it
+    worked. If lock_cache is given and another worker already holds the warm-up lock
+    in it, nothing is done."""
+    if lock_cache is not None and not lock_cache.add("warmup-lock", os.getpid(), CACHE_WARMUP_LOCK_TTL):
+        update_progress(state="skipped")
+        return
+
+    with app.app_context():
+        targets = rank_by_favorites()
+        update_progress(state="running", total=len(targets), done=0, failed=0, current=None,
+                        started_at=time.time(), finished_at=None)
+
+        with ratelimit_util.priority(ratelimit_util.BACKGROUND):
+            for kind, row in targets:
+                update_progress(current="{} {}".format(kind, row.series_name if kind == "series" else row.author_name))
+
+                try:
+                    worked = warm(kind, row)
+                except Exception:
+                    db.session.rollback()
+                    worked = False
+
+                with _progress_lock:
+                    progress["done"] += 1
+                    progress["failed"] += not worked
+
+        update_progress(state="done", current=None, finished_at=time.time())
+
+
+def start_warmup(app, warm, lock_cache=None, delay=None):
+    """ Starts run_warmup in a background thread after delay seconds
+    (CACHE_WARMUP_DELAY by default), without blocking the caller."""
+    delay = CACHE_WARMUP_DELAY if delay is None else delay
+    update_progress(state="waiting")
+
+    def run():
+        time.sleep(delay)
+        run_warmup(app, warm, lock_cache)
+
+    thread = threading.Thread(target=run, name="cache-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,7 @@
+""" WSGI entry point for production servers, e.g.
+gunicorn -c gunicorn.conf.py wsgi:app """
+import os
+
+from server import create_app
+
+app = create_app(os.environ.get("DATABASE_URL", "postgresql:///project"))